@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of `fast_calculate_changes` against the original `calculate_changes`.
+
+Usage: python benchmarks/bench_accuratechanges.py [n_patches]
+"""
+import difflib
+import random
+import sys
+import timeit
+
+from commitexplorer.util.accuratechanges import calculate_changes, fast_calculate_changes
+
+
+def random_line(rnd: random.Random) -> str:
+    indent = '    ' * rnd.randint(0, 3)
+    words = ['int', 'return', 'foo', 'bar(baz);', '}', '{', 'if', '(x', '==', 'null)', 'this.value', '=', '+', '1;', '//', 'TODO']
+    return indent + ' '.join(rnd.choice(words) for _ in range(rnd.randint(0, 12)))
+
+
+def random_patch(rnd: random.Random, n_lines: int) -> str:
+    old = [random_line(rnd) for _ in range(n_lines)]
+    new = list(old)
+    for _ in range(max(1, n_lines // 10)):
+        i = rnd.randrange(len(new))
+        op = rnd.random()
+        if op < 0.3:
+            new.pop(i)
+        elif op < 0.6:
+            new.insert(i, random_line(rnd))
+        else:
+            new[i] = new[i].replace(rnd.choice(new[i].split() or ['x']), random_line(rnd).strip(), 1)
+    # pydriller patches start with the first hunk header
+    return '\n'.join(list(difflib.unified_diff(old, new, lineterm=''))[2:]) + '\n'
+
+
+def main(n_patches: int = 200) -> None:
+    rnd = random.Random(42)
+    patches = [random_patch(rnd, rnd.choice([20, 200, 2000])) for _ in range(n_patches)]
+
+    for patch in patches:
+        if calculate_changes(patch) != fast_calculate_changes(patch):
+            raise AssertionError(f'Outputs differ for patch:\n{patch}')
+
+    old_time = min(timeit.repeat(lambda: [calculate_changes(p) for p in patches], number=1, repeat=3))
+    # the line-pair cache lives only for one patch, so every run starts cold
+    new_time = min(timeit.repeat(lambda: [fast_calculate_changes(p) for p in patches], number=1, repeat=3))
+    print(f'{n_patches} patches, {sum(len(p) for p in patches) // 1024} KB')
+    print(f'calculate_changes:      {old_time:.3f}s')
+    print(f'fast_calculate_changes: {new_time:.3f}s ({old_time / new_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
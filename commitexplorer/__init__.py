@@ -1,9 +1,8 @@
 import logging
 
+from importlib.metadata import version as distribution_version
 from pathlib import Path
 
-import pkg_resources
-
 
 class CustomFormatter(logging.Formatter):
 
@@ -45,7 +44,7 @@ project_root = commit_explorer_root.parent
 
 
 def version() -> str:
-    return pkg_resources.get_distribution('commit-explorer').version
+    return distribution_version('commit-explorer')
 
 
 __version__ = version()
\ No newline at end of file
@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import zlib
+from typing import Any, Dict, List, Optional, Set
+
+from bson import Binary
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+
+BLOB_REF_KEY = '_blob'
+BLOBS_COLLECTION = 'blobs'
+# shorter texts stay inline, a reference would not be much smaller
+MIN_BLOB_SIZE = 1024
+# compressed texts larger than this stay inline too (and are encoded with the rest of the value, see `commitexplorer.codec`),
+# leaving room for the other fields of the 16MB blob document
+MAX_BLOB_SIZE = 15 * 1024 * 1024
+
+
+class BlobStore:
+    """
+    Content-addressed store for large text values (e.g. patches) kept outside of commit documents,
+    in the `blobs` collection of the database, so every reader of the database can resolve references to them.
+
+    Blobs are keyed by the sha256 of their content and stored zlib-compressed,
+    so the same patch mined from different forks is stored only once.
+
+    >>> from commitexplorer.db import TmpMongo
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...     store = BlobStore(db)
+    ...     refs = store.put_many(['+a\\n' * 1000, '+a\\n' * 1000, '+b'])
+    ...     refs[0] == refs[1], refs[0]['size'], refs[2], db[BLOBS_COLLECTION].count_documents({})
+    ...     store.get_many([refs[0][BLOB_REF_KEY], 'ab12']) == {refs[0][BLOB_REF_KEY]: '+a\\n' * 1000}
+    (True, 3000, '+b', 1)
+    True
+    """
+    def __init__(self, database):
+        self.collection = database[BLOBS_COLLECTION]
+
+    def put_many(self, texts: List[str]) -> List[Any]:
+        """
+        Stores the texts with one query for the blobs that already exist and one bulk write for the others,
+        and returns a reference for each of them, or the text itself if it is too small or too large for a blob.
+        """
+        values = []
+        new_blobs = {}
+        for text in texts:
+            data = text.encode('utf-8')
+            if len(data) < MIN_BLOB_SIZE:
+                values.append(text)
+                continue
+            compressed = zlib.compress(data)
+            if len(compressed) > MAX_BLOB_SIZE:
+                values.append(text)
+                continue
+            key = hashlib.sha256(data).hexdigest()
+            new_blobs[key] = {'data': Binary(compressed), 'size': len(data)}
+            values.append({BLOB_REF_KEY: key, 'size': len(data)})
+        if new_blobs:
+            existing = {doc['_id'] for doc in self.collection.find({'_id': {'$in': list(new_blobs)}}, {'_id': 1})}
+            operations = [UpdateOne({'_id': key}, {'$setOnInsert': blob}, upsert=True)
+                          for key, blob in new_blobs.items() if key not in existing]
+            if operations:
+                self.collection.bulk_write(operations, ordered=False)
+        return values
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """
+        Returns the content of the blobs that exist, by key.
+        """
+        return {doc['_id']: zlib.decompress(bytes(doc['data'])).decode('utf-8')
+                for doc in self.collection.find({'_id': {'$in': keys}}, {'data': 1})}
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and BLOB_REF_KEY in value and len(value) == 2 and 'size' in value
+
+
+def collect_blob_keys(value: Any, keys: Set[str]) -> None:
+    if is_blob_ref(value):
+        keys.add(value[BLOB_REF_KEY])
+    elif isinstance(value, dict):
+        for item in value.values():
+            collect_blob_keys(item, keys)
+    elif isinstance(value, list):
+        for item in value:
+            collect_blob_keys(item, keys)
+
+
+def replace_blob_refs(value: Any, blobs: Dict[str, str]) -> Any:
+    if is_blob_ref(value):
+        return blobs.get(value[BLOB_REF_KEY], value)
+    if isinstance(value, dict):
+        return {k: replace_blob_refs(v, blobs) for k, v in value.items()}
+    if isinstance(value, list):
+        return [replace_blob_refs(v, blobs) for v in value]
+    return value
+
+
+def inline_blobs(value: Any, store: Optional[BlobStore]) -> Any:
+    """
+    Replaces blob references anywhere in `value` with the stored content, all blobs are read with one query.
+    References to blobs missing in the store, or all of them if there is no store, are left as they are.
+
+    >>> from commitexplorer.db import TmpMongo
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...     store = BlobStore(db)
+    ...     patch = store.put_many(['+a' * 1000])[0]
+    ...     inline_blobs({'files': [{'filename': 'a.py', 'patch': patch, 'changes': {'_blob': 'ab12', 'size': 3}}]}, store) \\
+    ...         == {'files': [{'filename': 'a.py', 'patch': '+a' * 1000, 'changes': {'_blob': 'ab12', 'size': 3}}]}
+    True
+    """
+    if store is None:
+        return value
+    keys = set()
+    collect_blob_keys(value, keys)
+    if not keys:
+        return value
+    blobs = store.get_many(list(keys))
+    if len(blobs) < len(keys):
+        logger.warning(f'Blobs {sorted(keys - blobs.keys())} not found in {store.collection.name}')
+    return replace_blob_refs(value, blobs)
@@ -1,13 +1,19 @@
+import importlib.util
+import json
 import logging
 import os
+import time
 from configparser import ConfigParser
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Optional, TextIO, Tuple
 
 import click
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 
 from commitexplorer import __version__, project_root
-from commitexplorer import mine as m
+from commitexplorer.blobstore import BlobStore, inline_blobs
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
@@ -31,31 +37,181 @@ def get_db():
     return db
 
 
-db = get_db()
-
-
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(__version__)
 def ce():
     pass
 
 
+SHOW_BATCH_SIZE = 1000
+
+
+def iter_input_shas(shas: Tuple[str, ...], input_file: Optional[TextIO]) -> Iterator[str]:
+    """
+    Yields shas given as arguments, reading them from stdin in place of `-`, and then those from `input_file`, one per line.
+    """
+    sources = [click.get_text_stream('stdin') if sha == '-' else [sha] for sha in shas]
+    if input_file is not None:
+        sources.append(input_file)
+    for lines in sources:
+        for line in lines:
+            if line.strip():
+                yield line.strip()
+
+
+def split_fields(values: Tuple[str, ...]) -> Optional[List[str]]:
+    """
+    >>> split_fields(('message,files.filename', 'owner')), split_fields(())
+    (['message', 'files.filename', 'owner'], None)
+    """
+    return [field for value in values for field in value.split(',') if field] or None
+
+
 @ce.command()
-@click.argument("sha")
-def show(sha: str) -> None:
+@click.argument('shas', nargs=-1)
+@click.option('--file', '-f', 'input_file', type=click.File('r'), help='Read shas from FILE, one per line (`-` for stdin).')
+@click.option('--include', multiple=True, help='Only output these fields, comma-separated or repeated, e.g. message,files.filename.')
+@click.option('--exclude', multiple=True, help='Output all fields except these ones.')
+@click.option('--batch-size', default=SHOW_BATCH_SIZE, show_default=True, help='Number of commits fetched with one query.')
+def show(shas: Tuple[str, ...], input_file: Optional[TextIO], include: Tuple[str, ...], exclude: Tuple[str, ...], batch_size: int) -> None:
+    """
+    Prints commits with the given SHAS (`-` reads them from stdin) as JSON Lines, in the order they are given.
+    Shas that are not found are reported to stderr.
+    """
+    from bson import json_util
+    from commitexplorer.db import iter_commits, get_projection
+    try:
+        projection = get_projection(split_fields(include), split_fields(exclude))
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+    db = get_db()
+    blob_store = BlobStore(db)
+    input_shas = iter_input_shas(shas, input_file)
     try:
-        commit = db.commits.find_one({'_id': sha})
-        if commit is not None:
-            print(commit)
-        else:
-            print(f"Commit with sha {sha} is not found")
+        while True:
+            batch = list(islice(input_shas, batch_size))
+            if not batch:
+                break
+            found = set()
+            for commit in iter_commits(db, batch, projection=projection):
+                found.add(commit['_id'])
+                click.echo(json_util.dumps(inline_blobs(commit, blob_store), json_options=json_util.RELAXED_JSON_OPTIONS))
+            for sha in batch:
+                if sha not in found:
+                    click.echo(f"Commit with sha {sha} is not found", err=True)
     except ConnectionFailure:
-        print(f"Connection to db failed")
+        raise click.ClickException("Connection to db failed")
+
+
+@ce.command()
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--with-field', help='Only export commits with this tool result or label set, e.g. refactoring_miner/2_1_0 or manual_labels.herzig.')
+@click.option('--incremental', is_flag=True, help='Only export commits updated since the last export to OUTPUT_DIR.')
+@click.option('--batch-size', default=50000, show_default=True, help='Number of commits per Parquet file.')
+def export(output_dir: str, with_field: Optional[str], incremental: bool, batch_size: int) -> None:
+    if importlib.util.find_spec('pyarrow') is None:
+        raise click.ClickException('pyarrow is required for exporting, install it with `pip install commit-explorer[export]`')
+    from commitexplorer.export import export_to_parquet
+    n_exported = export_to_parquet(get_db(), Path(output_dir), with_field, incremental, batch_size)
+    print(f'Exported {n_exported} commits to {output_dir}')
+
+
+@ce.group()
+def index() -> None:
+    """Manage MongoDB indexes declared in commitexplorer.indexes."""
+
+
+@index.command()
+@click.option('--drop-unknown', is_flag=True, help='Drop indexes that are not declared in the spec.')
+def sync(drop_unknown: bool) -> None:
+    from commitexplorer.indexes import sync_indexes
+    report = sync_indexes(get_db(), drop_unknown=drop_unknown)
+    for action, names in report.items():
+        print(f'{action}: {len(names)}')
+        for name in names if action != 'unchanged' else []:
+            print(f'    {name}')
+
+
+@index.command()
+def status() -> None:
+    from commitexplorer.indexes import index_status
+    rows = index_status(get_db())
+    print(f'{"index":<70} {"size (MB)":>10} {"ops":>10}  notes')
+    for row in rows:
+        notes = []
+        if row.get('missing'):
+            notes.append('missing')
+        elif not row['up_to_date']:
+            notes.append('not managed' if not row['managed'] else 'outdated')
+        if not row.get('missing') and row['ops'] == 0:
+            notes.append('unused')
+        print(f'{row["collection"] + "." + row["name"]:<70} {row["size"] / 1024 / 1024:>10.1f} {row["ops"]:>10}  {", ".join(notes)}')
+
+
+@ce.group()
+def migrate() -> None:
+    """Run database migrations from commitexplorer.migrate."""
+
+
+@migrate.command('list')
+def list_migrations() -> None:
+    from commitexplorer.migrate.runner import migration_registry, get_migration_states
+    states = get_migration_states(get_db())
+    for migration_id in migration_registry:
+        state = states.get(migration_id, {})
+        print(f'{migration_id:<40} {state.get("status", "not applied"):<12} {state.get("applied_at", "")}')
+
+
+@migrate.command('run')
+@click.argument('migration_id')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--rate-limit', type=float, help='Maximum number of documents processed per second.')
+@click.option('--workers', default=4, show_default=True, help='Number of _id ranges migrated in parallel.')
+@click.option('--force', is_flag=True, help='Run the migration from scratch even if it is already applied.')
+def run_migration(migration_id: str, batch_size: int, rate_limit: Optional[float], workers: int, force: bool) -> None:
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db(), batch_size=batch_size, max_docs_per_second=rate_limit, n_workers=workers).run(migration_id, force=force)
+
+
+@ce.group()
+def stats() -> None:
+    """Precomputed statistics of projects and tools, see commitexplorer.stats."""
+
+
+@stats.command()
+@click.option('--all', 'full', is_flag=True, help='Recompute the stats of all projects, not only of those with new results.')
+@click.option('--interval', type=float, help='Keep running and refresh the stats every INTERVAL seconds.')
+def refresh(full: bool, interval: Optional[float]) -> None:
+    from commitexplorer.stats import refresh_stats
+    db = get_db()
+    while True:
+        n_refreshed = refresh_stats(db, full=full)
+        print(f'Refreshed stats of {n_refreshed} projects')
+        if interval is None:
+            return
+        full = False
+        time.sleep(interval)
+
+
+@stats.command('show')
+@click.argument('project', required=False)
+@click.option('--tool', help='Show the stats of a single tool across all projects, e.g. refactoring_miner/2_1_0.')
+def show_stats(project: Optional[str], tool: Optional[str]) -> None:
+    from commitexplorer.stats import get_stats, get_tool_stats
+    if tool is not None:
+        result = get_tool_stats(get_db(), tool)
+    else:
+        result = get_stats(get_db(), project)
+    if result is None:
+        raise click.ClickException(f'No stats found for {tool or project or "the database"}, run `ce stats refresh` first')
+    print(json.dumps(result, indent=2, default=str))
 
 
 @ce.command()
 def mine() -> None:
-    m.mine(db)
+    # the mining machinery (pygit2, pydriller, github) is only needed here
+    from commitexplorer import mine as m
+    m.mine(get_db())
 
 
 if __name__ == '__main__':
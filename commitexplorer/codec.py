@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import zlib
+from typing import Any, Dict
+
+import bson
+from bson import Binary
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+
+CODEC_KEY = '_codec'
+CODEC_BSON_ZLIB = 'bson+zlib'
+CHUNKS_COLLECTION = 'chunks'
+# fields of an encoded value, to be projected together with subfields of the value
+CODEC_FIELDS = [CODEC_KEY, 'size', 'data', 'key', 'chunks']
+
+# values whose BSON encoding is smaller than this are stored as they are (a threshold of 0 encodes every value)
+ENCODE_THRESHOLD = 256 * 1024
+# compressed values larger than this are split into chunks, leaving room for other fields in the 16MB document
+MAX_INLINE_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+# assumed size of items of deeply nested containers when estimating the size of a value
+ROUGH_ITEM_SIZE = 32
+# number of items of a list the size of the whole list is extrapolated from
+SAMPLE_SIZE = 8
+
+
+def is_encoded(value: Any) -> bool:
+    return isinstance(value, dict) and value.get(CODEC_KEY) == CODEC_BSON_ZLIB
+
+
+def estimate_size(value: Any, depth: int = 3) -> int:
+    """
+    Rough size of `value` in bytes, computed without serializing it: strings are measured by their length,
+    the size of a list is extrapolated from its first items, and containers nested deeper than `depth`
+    are estimated by their number of items. Values are only serialized to measure them exactly
+    if the estimate gets close to the threshold.
+
+    >>> estimate_size({'status': 'ok', 'refactorings': [{'type': 'Rename Method', 'line': 10}] * 100})
+    2920
+    >>> estimate_size([{'filename': 'a.py', 'patch': 'x' * 1000}] * 1000)
+    1017000
+    """
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        if depth == 0:
+            return ROUGH_ITEM_SIZE * len(value)
+        return sum(len(key) + estimate_size(item, depth - 1) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if depth == 0 or not value:
+            return ROUGH_ITEM_SIZE * len(value)
+        sample = value[:SAMPLE_SIZE]
+        return len(value) * sum(estimate_size(item, depth - 1) for item in sample) // len(sample)
+    return 8
+
+
+def encode_value(value: Any, database=None, threshold: int = ENCODE_THRESHOLD, max_inline_size: int = MAX_INLINE_SIZE) -> Any:
+    """
+    Serializes large values with BSON and compresses them with zlib (level 1, which is fast and
+    works well on the repetitive JSON-like output of the tools). The compressed bytes are stored inline as BSON binary,
+    or, if they are still too large and a `database` is given, in content-addressed documents of the `chunks` collection.
+    Without a `database` such values are returned as they are, to be externalized only if writing them fails
+    (see `db.save_commit_result`).
+
+    Values estimated to be well below the threshold are returned without serializing them.
+
+    >>> encode_value({'a': 1})
+    {'a': 1}
+    >>> encoded = encode_value(['x' * 1000] * 1000)
+    >>> encoded[CODEC_KEY], encoded['size'], len(encoded['data']) < 10000
+    ('bson+zlib', 1009903, True)
+    >>> decode_value(encoded, None) == ['x' * 1000] * 1000
+    True
+    """
+    if estimate_size(value) < threshold // 2:
+        return value
+    raw = bson.encode({'v': value})
+    if len(raw) < threshold:
+        return value
+    data = zlib.compress(raw, 1)
+    if len(data) <= max_inline_size:
+        return {CODEC_KEY: CODEC_BSON_ZLIB, 'size': len(raw), 'data': Binary(data)}
+    if database is None:
+        return value
+    key = hashlib.sha256(data).hexdigest()
+    chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    database[CHUNKS_COLLECTION].bulk_write([
+        UpdateOne({'_id': f'{key}:{i}'}, {'$setOnInsert': {'data': Binary(chunk)}}, upsert=True) for i, chunk in enumerate(chunks)
+    ], ordered=False)
+    logger.debug(f'Value of {len(raw)} bytes stored in {len(chunks)} chunks ({key})')
+    return {CODEC_KEY: CODEC_BSON_ZLIB, 'size': len(raw), 'key': key, 'chunks': len(chunks)}
+
+
+def decode_value(value: Any, database) -> Any:
+    if not is_encoded(value):
+        return value
+    if 'data' in value:
+        data = bytes(value['data'])
+    else:
+        ids = [f'{value["key"]}:{i}' for i in range(value['chunks'])]
+        chunks = {chunk['_id']: bytes(chunk['data']) for chunk in database[CHUNKS_COLLECTION].find({'_id': {'$in': ids}})}
+        if len(chunks) != len(ids):
+            logger.warning(f'Some chunks of {value["key"]} are missing')
+            return value
+        data = b''.join(chunks[chunk_id] for chunk_id in ids)
+    return bson.decode(zlib.decompress(data))['v']
+
+
+def decode_document(document: Dict[str, Any], database) -> Dict[str, Any]:
+    return {key: decode_value(value, database) for key, value in document.items()}
@@ -4,7 +4,9 @@ import os
 import shutil
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Any, Optional, Dict, Tuple, Union, NewType, List, Generator, Set, TypeVar
 
 import github.Repository as githubrepo
@@ -163,10 +165,43 @@ def commit_boundary_generator(lst: List, chunk_size) -> Generator[List[Any], Non
         yield lst[newer_index: older_index+1]
 
 
+class CommitBatch:
+    """
+    Columnar view of a list of commits passed to `Tool.run_on_batch`. Columns are extracted lazily,
+    so a tool only pays for the columns it uses.
+
+    >>> batch = CommitBatch([SimpleNamespace(hex='a1', message='fix', parent_ids=['b2']), SimpleNamespace(hex='b2', message='init', parent_ids=[])])
+    >>> batch.shas, batch.messages, batch.parent_ids
+    (['a1', 'b2'], ['fix', 'init'], [['b2'], []])
+    """
+    def __init__(self, commits: List[pygit2.Commit]):
+        self.commits = commits
+
+    def __len__(self):
+        return len(self.commits)
+
+    @cached_property
+    def shas(self) -> List[Sha]:
+        return [commit.hex for commit in self.commits]
+
+    @cached_property
+    def messages(self) -> List[str]:
+        return [commit.message for commit in self.commits]
+
+    @cached_property
+    def parent_ids(self) -> List[List[Sha]]:
+        return [[str(parent_id) for parent_id in commit.parent_ids] for commit in self.commits]
+
+
 @dataclass
 class Tool(ABC):
     version: Optional[str]
     lightweight_commits: bool = field(default=False, init=False)
+    # tools that set it implement `run_on_batch` and get whole batches of commits instead of commit ranges
+    batch_api: bool = field(default=False, init=False)
+    # the database results are saved to, set by the miner for tools that store data outside of results (e.g. blobs)
+    database: Any = field(default=None, init=False, repr=False)
+    batch_size = 100000
 
     def __post_init__(self):
         with open(project_root / 'github.token', 'r') as f:
@@ -177,6 +212,9 @@ class Tool(ABC):
             self.path = None
 
     def run_on_project(self, project: ProjectObj, commits_new_to_old: List[pygit2.Commit], limited_to_shas: Optional[Set[Sha]] = None) -> Generator[Dict[Sha, Any], None, None]:
+        if self.batch_api:
+            yield from self.run_on_batches(commits_new_to_old, limited_to_shas)
+            return
         commit_chunk = 100
         max_seconds_per_commit = 6
         repo, metadata = clone_project(project, self.token, return_metadata=True)
@@ -208,6 +246,19 @@ class Tool(ABC):
             commit_range = [commit for commit in commit_range if getattr(commit, hash) in limited_to_shas]
         return {getattr(commit, hash): self.run_on_commit(commit) for commit in commit_range}
 
+    def run_on_batches(self, commits_new_to_old: List[pygit2.Commit], limited_to_shas: Optional[Set[Sha]] = None) -> Generator[Dict[Sha, Any], None, None]:
+        if limited_to_shas is not None:
+            commits_new_to_old = [commit for commit in commits_new_to_old if commit.hex in limited_to_shas]
+        for i in tqdm(range(0, len(commits_new_to_old), self.batch_size), desc="Commit batches: "):
+            yield self.run_on_batch(CommitBatch(commits_new_to_old[i: i + self.batch_size]))
+
+    def run_on_batch(self, batch: CommitBatch) -> Dict[Sha, Any]:
+        """
+        Default for tools that set `batch_api` without a vectorized implementation: runs `run_on_commit` on each commit.
+        Commits of a batch are pygit2 commits, as passed to `run_on_commit` of tools with `lightweight_commits`.
+        """
+        return {sha: self.run_on_commit(commit) for sha, commit in zip(batch.shas, batch.commits)}
+
     @abstractmethod
     def run_on_commit(self, commit: pydriller.Commit):
         pass
@@ -1,15 +1,41 @@
+import logging
+import os
+import re
+from itertools import groupby
 from types import SimpleNamespace
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Set, Tuple, Generator, Iterable, Optional
 
 import pymongo as pymongo
-from pymongo.errors import WriteError, DocumentTooLarge
+from pymongo import UpdateOne
+from pymongo.errors import WriteError, DocumentTooLarge, BulkWriteError
 from pygit2 import Commit
 
+from commitexplorer.codec import encode_value, decode_document, is_encoded, CODEC_KEY, CODEC_FIELDS
 from commitexplorer.common import GithubProject, Sha, ProjectObj, GitProject
+from commitexplorer.indexes import tool_result_index_name
 from datetime import datetime
 
 
+logger = logging.getLogger(__name__)
+
+
 DOT_REPLACEMENT = '_'
+SAVE_RESULTS_BATCH_SIZE = 1000
+
+# `embedded`: results of all tools are fields of the commit document in the `commits` collection;
+# `per_tool`: results of each tool version are stored in a separate collection (see `tool_collection_name`),
+# the `commits` collection only keeps project info and labels.
+STORAGE_LAYOUT_EMBEDDED = 'embedded'
+STORAGE_LAYOUT_PER_TOOL = 'per_tool'
+STORAGE_LAYOUT = os.environ.get('COMMIT_EXPLORER_STORAGE_LAYOUT', STORAGE_LAYOUT_EMBEDDED)
+if STORAGE_LAYOUT not in [STORAGE_LAYOUT_EMBEDDED, STORAGE_LAYOUT_PER_TOOL]:
+    raise ValueError(f'Unknown storage layout: {STORAGE_LAYOUT}, '
+                     f'COMMIT_EXPLORER_STORAGE_LAYOUT must be one of: {STORAGE_LAYOUT_EMBEDDED}, {STORAGE_LAYOUT_PER_TOOL}')
+TOOL_COLLECTION_PREFIX = 'tool.'
+# set by the server whenever tool results of a commit are saved, used for incremental exports
+UPDATED_AT = 'updated_at'
+# materialized statistics, see commitexplorer.stats
+STATS_COLLECTION = 'stats'
 
 
 def escape_dot(s: str) -> str:
@@ -20,6 +46,30 @@ def escape_dot(s: str) -> str:
     return s.replace('.', DOT_REPLACEMENT)
 
 
+def tool_collection_name(tool_id: str) -> str:
+    """
+    >>> tool_collection_name('refactoring_miner/2.1.0')
+    'tool.refactoring_miner.2_1_0'
+    >>> tool_collection_name('files')
+    'tool.files'
+    """
+    return TOOL_COLLECTION_PREFIX + escape_dot(tool_id).replace('/', '.')
+
+
+def tool_field_from_collection_name(collection_name: str) -> str:
+    """
+    >>> tool_field_from_collection_name('tool.refactoring_miner.2_1_0')
+    'refactoring_miner/2_1_0'
+    >>> tool_field_from_collection_name('tool.files')
+    'files'
+    """
+    return collection_name[len(TOOL_COLLECTION_PREFIX):].replace('.', '/', 1)
+
+
+def get_tool_collection_names(database) -> List[str]:
+    return sorted(database.list_collection_names(filter={'name': {'$regex': '^' + re.escape(TOOL_COLLECTION_PREFIX)}}))
+
+
 class TmpMongo:
     def __init__(self, uri: str):
         self.uri = uri
@@ -33,39 +83,148 @@ class TmpMongo:
         self.client.drop_database(self.db_name)
 
 
-def save_results(results: Dict[Sha, Dict[str, Any]], project: ProjectObj, db) -> None:
+def set_on_insert_dict(sha: Sha, project: ProjectObj) -> Dict[str, Any]:
+    if isinstance(project, GithubProject):
+        return {'_id': sha, 'owner': project.owner, 'repo': project.repo}
+    elif isinstance(project, GitProject):
+        return {'_id': sha, 'url': project.get_url()}
+    else:
+        raise AssertionError()
+
+
+def save_results(results: Dict[Sha, Dict[str, Any]], project: ProjectObj, db, batch_size: int = SAVE_RESULTS_BATCH_SIZE,
+                 layout: str = STORAGE_LAYOUT) -> None:
     """
     >>> with TmpMongo('mongodb://localhost:27017') as db:
-    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': {}, 'tool2/2.0': {}}}, SimpleNamespace(owner='giganticode', repo='bohr'), db)
-    ...    save_results({'abc34dbc33747830aff': {'tool2/3.0': {}}}, SimpleNamespace(owner='giganticode', repo='bohr'), db)
-    ...    db.commits.find_one({'_id': 'abc34dbc33747830aff'})
+    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': {}, 'tool2/2.0': {}}}, GithubProject('giganticode', 'bohr'), db)
+    ...    save_results({'abc34dbc33747830aff': {'tool2/3.0': {}}}, GithubProject('giganticode', 'bohr'), db)
+    ...    db.commits.find_one({'_id': 'abc34dbc33747830aff'}, {'updated_at': 0})
     {'_id': 'abc34dbc33747830aff', 'owner': 'giganticode', 'repo': 'bohr', 'tool1/1_0': {}, 'tool2/2_0': {}, 'tool2/3_0': {}}
 
     >>> with TmpMongo('mongodb://localhost:27017') as db:
     ...    lots_of_data = 'a' * 1024 * 1024 * 20
-    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': lots_of_data, 'tool2/2.0': {}}}, SimpleNamespace(owner='giganticode', repo='bohr'), db)
-    ...    db.commits.find_one({'_id': 'abc34dbc33747830aff'})
-    {'_id': 'abc34dbc33747830aff', 'owner': 'giganticode', 'repo': 'bohr', 'tool1/1_0': {'status': 'value-too-large'}, 'tool2/2_0': {}}
+    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': lots_of_data, 'tool2/2.0': {}}}, GithubProject('giganticode', 'bohr'), db)
+    ...    db.commits.find_one({'_id': 'abc34dbc33747830aff'})['tool1/1_0'][CODEC_KEY], get_commit(db, 'abc34dbc33747830aff')['tool1/1_0'] == lots_of_data
+    ('bson+zlib', True)
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': {'a': 1}}}, GithubProject('giganticode', 'bohr'), db, layout='per_tool')
+    ...    db.commits.find_one({'_id': 'abc34dbc33747830aff'}, {'updated_at': 0}), db['tool.tool1.1_0'].find_one({'_id': 'abc34dbc33747830aff'}, {'updated_at': 0})
+    ({'_id': 'abc34dbc33747830aff', 'owner': 'giganticode', 'repo': 'bohr'}, {'_id': 'abc34dbc33747830aff', 'result': {'a': 1}})
+    """
+    commit_results = [(sha, tool_result) for sha, tool_result in results.items() if tool_result]
+    for i in range(0, len(commit_results), batch_size):
+        if layout == STORAGE_LAYOUT_PER_TOOL:
+            save_result_batch_per_tool(commit_results[i:i + batch_size], project, db)
+        else:
+            save_result_batch(commit_results[i:i + batch_size], project, db)
+    if commit_results:
+        mark_stats_dirty(project, db)
+
+
+def mark_stats_dirty(project: ProjectObj, db) -> None:
+    """
+    Flags the statistics of the project as outdated, they are recomputed by `ce stats refresh`.
+    The version is incremented so that a refresh running concurrently does not clear the flag.
+    Commits shared by forks are counted for the project that saved them first; if a fork saves results for them,
+    they are only picked up by the next `ce stats refresh --all`, so that saving results does not have to read the owners.
+    """
+    db[STATS_COLLECTION].update_one({'_id': project.get_repo_id()},
+                                    {'$set': {'dirty': True}, '$inc': {'dirty_version': 1}}, upsert=True)
+
+
+def save_result_batch(commit_results: List[Tuple[Sha, Dict[str, Any]]], project: ProjectObj, db) -> None:
     """
-    for sha, tool_result in results.items():
+    Writes results of all tools for each commit with a single upsert, sending the whole batch in one unordered bulk write.
+    Only documents that fail (e.g. because they grow too large) are retried one by one.
+    """
+    operations = [UpdateOne({'_id': sha}, {
+        '$setOnInsert': set_on_insert_dict(sha, project),
+        '$set': encode_tool_result(tool_result),
+        '$currentDate': {UPDATED_AT: True}
+    }, upsert=True) for sha, tool_result in commit_results]
+    try:
+        db.commits.bulk_write(operations, ordered=False)
+    except BulkWriteError as ex:
+        failed_indices = sorted({error['index'] for error in ex.details['writeErrors']})
+        logger.warning(f'{len(failed_indices)}/{len(operations)} documents failed to be saved, retrying them one by one ...')
+        for i in failed_indices:
+            save_commit_result(*commit_results[i], project, db)
+    except DocumentTooLarge:
+        # raised before sending the offending document, so it is not known which one it is
+        logger.warning(f'A document in the batch is too large, saving {len(operations)} documents one by one ...')
+        for sha, tool_result in commit_results:
+            save_commit_result(sha, tool_result, project, db)
+
+
+def encode_tool_result(tool_result: Dict[str, Any]) -> Dict[str, Any]:
+    return {escape_dot(tool_id): encode_value(value) for tool_id, value in tool_result.items()}
+
+
+def save_commit_result(sha: Sha, tool_result: Dict[str, Any], project: ProjectObj, db) -> None:
+    """
+    If the document does not fit with all results, they are set one by one,
+    and those that still do not fit are moved to the `chunks` collection entirely.
+    """
+    set_on_insert_dct = set_on_insert_dict(sha, project)
+    try:
+        db.commits.update_one({'_id': sha}, {
+            '$setOnInsert': set_on_insert_dct,
+            '$set': encode_tool_result(tool_result),
+            '$currentDate': {UPDATED_AT: True}
+        }, upsert=True)
+        return
+    except (WriteError, DocumentTooLarge):
+        pass
+    for tool_id, value in tool_result.items():
+        tool_id = escape_dot(tool_id)
+        try:
+            db.commits.update_one({'_id': sha}, {
+                '$setOnInsert': set_on_insert_dct,
+                '$set': {tool_id: encode_value(value)},
+                '$currentDate': {UPDATED_AT: True}
+            }, upsert=True)
+        except (WriteError, DocumentTooLarge):
+            db.commits.update_one({'_id': sha}, {
+                '$setOnInsert': set_on_insert_dct,
+                '$set': {tool_id: encode_value(value, db, threshold=0, max_inline_size=0)},
+                '$currentDate': {UPDATED_AT: True}
+            }, upsert=True)
+
+
+def save_result_batch_per_tool(commit_results: List[Tuple[Sha, Dict[str, Any]]], project: ProjectObj, db) -> None:
+    """
+    Makes sure there is a document in the `commits` collection for each commit and writes
+    the result of each tool as a `{'_id': sha, 'result': value}` document to the tool's collection.
+    """
+    db.commits.bulk_write([UpdateOne({'_id': sha}, {'$setOnInsert': set_on_insert_dict(sha, project), '$currentDate': {UPDATED_AT: True}}, upsert=True)
+                           for sha, _ in commit_results], ordered=False)
+    results_by_tool: Dict[str, List[Tuple[Sha, Any]]] = {}
+    for sha, tool_result in commit_results:
         for tool_id, value in tool_result.items():
-            tool_id = escape_dot(tool_id)
-            if isinstance(project, GithubProject):
-                set_on_insert_dct = {'_id': sha, 'owner': project.owner, 'repo': project.repo}
-            elif isinstance(project, GitProject):
-                set_on_insert_dct = {'_id': sha, 'url': project.get_url()}
-            else:
-                raise AssertionError()
-            try:
-                db.commits.update_one({'_id': sha}, {
-                    '$setOnInsert': set_on_insert_dct,
-                    '$set': {tool_id: value}
-                }, upsert=True)
-            except (WriteError, DocumentTooLarge):
-                db.commits.update_one({'_id': sha}, {
-                    '$setOnInsert': set_on_insert_dct,
-                    '$set': {tool_id: {'status': 'value-too-large'}}
-                }, upsert=True)
+            results_by_tool.setdefault(tool_id, []).append((sha, value))
+    for tool_id, tool_results in results_by_tool.items():
+        save_tool_results(db[tool_collection_name(tool_id)], tool_results)
+
+
+def save_tool_results(collection, tool_results: List[Tuple[Sha, Any]]) -> None:
+    operations = [UpdateOne({'_id': sha}, {'$set': {'result': encode_value(value)}, '$currentDate': {UPDATED_AT: True}}, upsert=True)
+                  for sha, value in tool_results]
+    try:
+        collection.bulk_write(operations, ordered=False)
+        return
+    except BulkWriteError as ex:
+        failed = [tool_results[i] for i in sorted({error['index'] for error in ex.details['writeErrors']})]
+    except DocumentTooLarge:
+        failed = tool_results
+    logger.warning(f'{len(failed)}/{len(operations)} results failed to be saved to {collection.name}, retrying them one by one ...')
+    for sha, value in failed:
+        try:
+            collection.update_one({'_id': sha}, {'$set': {'result': encode_value(value)},
+                                                 '$currentDate': {UPDATED_AT: True}}, upsert=True)
+        except (WriteError, DocumentTooLarge):
+            collection.update_one({'_id': sha}, {'$set': {'result': encode_value(value, collection.database, threshold=0, max_inline_size=0)},
+                                                 '$currentDate': {UPDATED_AT: True}}, upsert=True)
 
 
 def mark_project_as_run(project: ProjectObj, tool_id: str, database):
@@ -91,7 +250,7 @@ def mark_project_as_run(project: ProjectObj, tool_id: str, database):
     ])
 
 
-def get_already_explored_commits(commits: List[Commit], tool_id: str, database) -> Dict[Sha, Commit]:
+def get_already_explored_commits(commits: List[Commit], tool_id: str, database, layout: str = STORAGE_LAYOUT) -> Dict[Sha, Commit]:
     """
     >>> with TmpMongo('mongodb://localhost:27017') as db: # doctest: +ELLIPSIS
     ...    res = db.commits.insert_one({'_id': '1', 'special_commit_finder/0_1': []})
@@ -99,15 +258,19 @@ def get_already_explored_commits(commits: List[Commit], tool_id: str, database)
     ...    res = db.commits.insert_one({'_id': '33', 'special_commit_finder/0_1': []})
     ...    commits = [SimpleNamespace(hex='1'), SimpleNamespace(hex='2'), SimpleNamespace(hex='3')]
     ...    get_already_explored_commits(commits, 'special_commit_finder/0.1', db)
-    {'1': {'_id': '1', 'special_commit_finder/0_1': []}}
+    {'1': {'_id': '1'}}
     """
     commit_hexes = [commit.hex for commit in commits]
-    commits_from_db = database.commits.find(
-        filter={'$and': [
-            {'_id': {'$in': commit_hexes}},
-            {escape_dot(tool_id): {'$exists': True}}
-        ]}
-    ) #TODO think about optimization, index on owner + repo, and query by project?
+    if layout == STORAGE_LAYOUT_PER_TOOL:
+        commits_from_db = database[tool_collection_name(tool_id)].find({'_id': {'$in': commit_hexes}}, {'_id': 1})
+    else:
+        commits_from_db = database.commits.find(
+            filter={'$and': [
+                {'_id': {'$in': commit_hexes}},
+                {escape_dot(tool_id): {'$exists': True}}
+            ]},
+            projection={'_id': 1}
+        )
     commits_from_db_dict = {commit['_id']: commit for commit in commits_from_db}
 
     return commits_from_db_dict
@@ -131,26 +294,278 @@ def get_tools_not_run_on_project(tools: List[str], project: ProjectObj, database
     return tools_not_run
 
 
-def get_important_commits(database, query) -> Dict[GithubProject, Set[Sha]]:
+def iter_important_commits(database, query) -> Generator[Tuple[ProjectObj, Set[Sha]], None, None]:
+    """
+    Streams commits matching `query` grouped by project. Only the fields needed to identify the project are projected,
+    and commits are sorted by project on the server and grouped here, so neither tool results nor all shas of a project
+    have to fit into one document.
+    """
+    pipeline = [
+        {'$match': query},
+        {'$project': {'_id': 1, 'owner': 1, 'repo': 1, 'url': 1}},
+        {'$sort': {'owner': 1, 'repo': 1, 'url': 1}},
+    ]
+    commits = database.commits.aggregate(pipeline, allowDiskUse=True)
+    for (owner, repo, url), group in groupby(commits, key=lambda c: (c.get('owner'), c.get('repo'), c.get('url'))):
+        shas = {commit['_id'] for commit in group}
+        if owner is not None:
+            project = GithubProject(owner, repo)
+        elif url is not None:
+            project = GitProject(url)
+        else:
+            logger.warning(f'{len(shas)} commits have neither owner/repo nor url, skipping them.')
+            continue
+        yield project, shas
+
+
+def get_important_commits(database, query) -> Dict[ProjectObj, Set[Sha]]:
     """
     >>> with TmpMongo('mongodb://localhost:27017') as db: # doctest: +ELLIPSIS
     ...    res = db.commits.insert_one({'_id': 'abc34dbc33747830af1', 'manual_labels': {'herzig': 1}, 'owner': 'a', 'repo': 'b'})
     ...    res = db.commits.insert_one({'_id': 'abc34dbc33747830af2', 'owner': 'a', 'repo': 'b'})
     ...    res = db.commits.insert_one({'_id': 'abc34dbc33747830af3', 'manual_labels': {'berger': 0}, 'owner': 'a', 'repo': 'c'})
     ...    res = db.commits.insert_one({'_id': 'abc34dbc33747830af4', })
-    ...    get_important_commits(db)
-    {Project(owner='a', repo='b'): {'abc34dbc33747830af1'}, Project(owner='a', repo='c'): {'abc34dbc33747830af3'}}
-    """
-    commits_from_db = database.commits.find(
-        filter=query
-    )
-    res = {}
-    for commit in commits_from_db:
-        if 'owner' in commit:
-            project = GithubProject(commit['owner'], commit['repo'])
+    ...    get_important_commits(db, {'manual_labels': {'$exists': True}})
+    {GithubProject(owner='a', repo='b'): {'abc34dbc33747830af1'}, GithubProject(owner='a', repo='c'): {'abc34dbc33747830af3'}}
+    """
+    return dict(iter_important_commits(database, query))
+
+
+def get_projection(include: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> Optional[Dict[str, int]]:
+    """
+    Builds a projection from included or excluded fields. If a subfield is included,
+    fields of an encoded value are included too, so that the value can be decoded.
+
+    >>> get_projection(include=['message', 'files.filename'])
+    {'message': 1, 'files.filename': 1, 'files._codec': 1, 'files.size': 1, 'files.data': 1, 'files.key': 1, 'files.chunks': 1}
+    >>> get_projection(exclude=['files'])
+    {'files': 0}
+    >>> get_projection()
+    >>> get_projection(include=['message'], exclude=['files'])
+    Traceback (most recent call last):
+    ...
+    ValueError: Fields can be either included or excluded, not both
+    >>> get_projection(exclude=['_id'])
+    Traceback (most recent call last):
+    ...
+    ValueError: _id cannot be excluded
+    """
+    if include and exclude:
+        raise ValueError('Fields can be either included or excluded, not both')
+    if exclude and '_id' in exclude:
+        raise ValueError('_id cannot be excluded')
+    if include:
+        projection = {}
+        for field in include:
+            projection[field] = 1
+            if '.' in field:
+                projection.update({f'{field.split(".")[0]}.{codec_field}': 1 for codec_field in CODEC_FIELDS})
+        return projection
+    if exclude:
+        return {field: 0 for field in exclude}
+    return None
+
+
+def get_tool_result_projection(field: str, projection: Optional[Dict[str, int]]) -> Tuple[bool, Optional[Dict[str, int]]]:
+    """
+    Translates a projection of commit documents to a projection of documents of a tool collection.
+    Returns whether the tool collection needs to be read at all, and the projection.
+
+    >>> get_tool_result_projection('files', {'message': 1, 'files.filename': 1})
+    (True, {'result.filename': 1})
+    >>> get_tool_result_projection('files', {'message': 1})
+    (False, None)
+    >>> get_tool_result_projection('files', {'files': 0})
+    (False, None)
+    >>> get_tool_result_projection('files', {'message': 0})
+    (True, None)
+    """
+    if projection is None:
+        return True, None
+    tool_projection = {}
+    for path, value in projection.items():
+        if path == field:
+            if value == 0:
+                return False, None
+            tool_projection['result'] = 1
+        elif path.startswith(field + '.'):
+            tool_projection['result' + path[len(field):]] = value
+    including = 1 in projection.values()
+    if including and not tool_projection:
+        return False, None
+    if 'result' in tool_projection:
+        return True, None
+    return True, tool_projection or None
+
+
+def project_subfields(value: Any, paths: List[str], include: bool) -> Any:
+    """
+    Applies subfield paths of a projection, relative to `value`, the way MongoDB applies them to stored values.
+    Used for values that are read as a whole because they are encoded by `commitexplorer.codec`.
+
+    >>> project_subfields([{'filename': 'a', 'patch': '+x'}, {'filename': 'b'}], ['filename'], include=True)
+    [{'filename': 'a'}, {'filename': 'b'}]
+    >>> project_subfields({'status': 'ok', 'refactorings': [{'type': 'A', 'left': []}]}, ['refactorings.left'], include=False)
+    {'status': 'ok', 'refactorings': [{'type': 'A'}]}
+    """
+    if isinstance(value, list):
+        return [project_subfields(item, paths, include) for item in value]
+    if not isinstance(value, dict):
+        return value
+    paths_by_key: Dict[str, List[str]] = {}
+    for path in paths:
+        key, _, rest = path.partition('.')
+        paths_by_key.setdefault(key, []).append(rest)
+    result = {} if include else dict(value)
+    for key, rests in paths_by_key.items():
+        if key not in value:
+            continue
+        if '' in rests:
+            if include:
+                result[key] = value[key]
+            else:
+                del result[key]
         else:
-            project = GitProject(commit['url'])
-        if not project in res:
-            res[project] = set()
-        res[project].add(commit['_id'])
-    return res
+            result[key] = project_subfields(value[key], rests, include)
+    return result
+
+
+def decode_commit(commit: Dict[str, Any], database, projection: Optional[Dict[str, int]]) -> Dict[str, Any]:
+    """
+    Decodes values encoded by `commitexplorer.codec` and applies subfield paths of the projection to them,
+    which MongoDB could not do, because it only sees their encoded form.
+    """
+    decoded = decode_document(commit, database)
+    if projection:
+        include = any(value == 1 for path, value in projection.items() if path != '_id')
+        for field, value in commit.items():
+            paths = [path[len(field) + 1:] for path in projection if path.startswith(field + '.')]
+            if is_encoded(value) and paths:
+                decoded[field] = project_subfields(decoded[field], paths, include)
+    return decoded
+
+
+def iter_commits(database, shas: Iterable[Sha], layout: str = STORAGE_LAYOUT, max_time_ms: Optional[int] = None,
+                 projection: Optional[Dict[str, int]] = None) -> Generator[Dict[str, Any], None, None]:
+    """
+    Merged read view over both storage layouts: yields commit documents as they would look in the `embedded` layout.
+    In the `per_tool` layout, results from tool collections are added to the commit documents,
+    fields that have not been migrated yet are taken from the `commits` collection.
+    Values encoded by `commitexplorer.codec` are decoded. All commits are read with one query per collection,
+    only the fields selected by `projection` (see `get_projection`) are read; subfields of encoded values are selected
+    after decoding them.
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db: # doctest: +ELLIPSIS
+    ...    save_results({'abc34dbc33747830aff': {'tool1/1.0': 1}}, GithubProject('giganticode', 'bohr'), db, layout='embedded')
+    ...    save_results({'abc34dbc33747830aff': {'tool2/1.0': 2}}, GithubProject('giganticode', 'bohr'), db, layout='per_tool')
+    ...    list(iter_commits(db, ['abc34dbc33747830aff', 'abc34dbc33747830ab0'], layout='per_tool'))
+    ...    list(iter_commits(db, ['abc34dbc33747830aff'], layout='per_tool', projection={'tool2/1_0': 1}))
+    [{'_id': 'abc34dbc33747830aff', 'owner': 'giganticode', 'repo': 'bohr', 'tool1/1_0': 1, 'updated_at': datetime.datetime(...), 'tool2/1_0': 2}]
+    [{'_id': 'abc34dbc33747830aff', 'tool2/1_0': 2}]
+    """
+    shas = list(shas)
+    commits = {commit['_id']: commit for commit in database.commits.find({'_id': {'$in': shas}}, projection).max_time_ms(max_time_ms)}
+    if layout == STORAGE_LAYOUT_PER_TOOL and commits:
+        for collection_name in get_tool_collection_names(database):
+            field = tool_field_from_collection_name(collection_name)
+            needed, tool_projection = get_tool_result_projection(field, projection)
+            if not needed:
+                continue
+            for doc in database[collection_name].find({'_id': {'$in': list(commits.keys())}}, tool_projection).max_time_ms(max_time_ms):
+                if 'result' in doc:
+                    commits[doc['_id']][field] = doc['result']
+    for sha in shas:
+        if sha in commits:
+            yield decode_commit(commits[sha], database, projection)
+
+
+def get_commit(database, sha: Sha, layout: str = STORAGE_LAYOUT, max_time_ms: Optional[int] = None,
+               projection: Optional[Dict[str, int]] = None) -> Optional[Dict[str, Any]]:
+    return next(iter_commits(database, [sha], layout, max_time_ms, projection), None)
+
+
+def get_commit_version(database, sha: Sha, max_time_ms: Optional[int] = None) -> Tuple[bool, Optional[datetime], List[Any]]:
+    """
+    Cheap check whether the commit exists, when it was last updated and which issues are linked to it,
+    without reading tool results. The version is None for documents that have never been written with `updated_at`.
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...    res = db.commits.insert_one({'_id': 'a', 'links': {'bohr': {'issues': [1, 2]}}})
+    ...    get_commit_version(db, 'a'), get_commit_version(db, 'b')
+    ((True, None, [1, 2]), (False, None, []))
+    """
+    commit = database.commits.find_one({'_id': sha}, {UPDATED_AT: 1, 'links.bohr.issues': 1}, max_time_ms=max_time_ms)
+    if commit is None:
+        return False, None, []
+    return True, commit.get(UPDATED_AT), commit.get('links', {}).get('bohr', {}).get('issues', [])
+
+
+def get_issues_version(database, issue_ids: List[Any], max_time_ms: Optional[int] = None) -> Optional[str]:
+    """
+    Combines ids and `updated_at` of the issues into one version, issues that do not exist are part of it as missing.
+    None if any of the issues has no `updated_at`.
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...    res = db.issues.insert_many([{'_id': 1, 'updated_at': datetime(2022, 1, 1)}, {'_id': 2}])
+    ...    get_issues_version(db, [1, 3]), get_issues_version(db, [1, 2]), get_issues_version(db, [])
+    ('1@2022-01-01 00:00:00,3@missing', None, '')
+    """
+    if not issue_ids:
+        return ''
+    versions = {issue['_id']: issue.get(UPDATED_AT) for issue in database.issues.find({'_id': {'$in': issue_ids}}, {UPDATED_AT: 1}).max_time_ms(max_time_ms)}
+    if None in versions.values():
+        return None
+    return ','.join(f'{issue_id}@{versions.get(issue_id, "missing")}' for issue_id in issue_ids)
+
+
+def get_field_query(database, field: str, layout: str = STORAGE_LAYOUT) -> Tuple[Any, Dict[str, Any], Optional[str]]:
+    """
+    Returns the collection, the query selecting commits that have `field` and the index to hint, if any.
+    In the `per_tool` layout, if `field` is a tool result, the tool's collection is read instead of the `commits` collection.
+    The query has no predicate on a key of the partial index of a tool result, so the index is only used if it is hinted.
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...    _ = db.commits.create_index([('_id', 1), ('tool.status', 1)], name='tool__tool', partialFilterExpression={'tool': {'$exists': True}})
+    ...    get_field_query(db, 'tool')[1:], get_field_query(db, 'message')[1:]
+    (({'tool': {'$exists': True}}, 'tool__tool'), ({'message': {'$exists': True}}, None))
+    """
+    if layout == STORAGE_LAYOUT_PER_TOOL and tool_collection_name(field) in get_tool_collection_names(database):
+        return database[tool_collection_name(field)], {}, None
+    index_name = tool_result_index_name(field)
+    return database.commits, {field: {'$exists': True}}, index_name if index_name in database.commits.index_information() else None
+
+
+def iter_shas_with_field(database, field: str, layout: str = STORAGE_LAYOUT, max_time_ms: Optional[int] = None,
+                         after: Optional[Sha] = None, limit: Optional[int] = None) -> Generator[Sha, None, None]:
+    """
+    Yields shas of commits that have `field`. If `after` or `limit` is given, shas are sorted,
+    and only `limit` shas following `after` are returned, which allows to page through the results.
+
+    >>> with TmpMongo('mongodb://localhost:27017') as db:
+    ...    res = db.commits.insert_many([{'_id': sha, 'tool': 1} for sha in ['c', 'a', 'b', 'd']])
+    ...    list(iter_shas_with_field(db, 'tool', after='a', limit=2)), list(iter_shas_with_field(db, 'tool', after='c', limit=2))
+    (['b', 'c'], ['d'])
+    """
+    collection, query, hint = get_field_query(database, field, layout)
+    if after is not None:
+        query = {'$and': [query, {'_id': {'$gt': after}}]}
+    cursor = collection.find(query, {'_id': 1}).max_time_ms(max_time_ms)
+    if hint is not None:
+        cursor = cursor.hint(hint)
+    if after is not None or limit is not None:
+        cursor = cursor.sort('_id', pymongo.ASCENDING)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    for doc in cursor:
+        yield doc['_id']
+
+
+def count_shas_with_field(database, field: str, layout: str = STORAGE_LAYOUT, max_time_ms: Optional[int] = None) -> int:
+    collection, query, hint = get_field_query(database, field, layout)
+    kwargs = {'maxTimeMS': max_time_ms} if max_time_ms is not None else {}
+    if not query:
+        # every document of a tool collection has the result, the count is taken from the collection metadata
+        return collection.estimated_document_count(**kwargs)
+    if hint is not None:
+        kwargs['hint'] = hint
+    return collection.count_documents(query, **kwargs)
@@ -0,0 +1,199 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional
+
+from commitexplorer.codec import decode_document, CODEC_FIELDS
+from commitexplorer.db import STORAGE_LAYOUT, STORAGE_LAYOUT_PER_TOOL, tool_collection_name, get_tool_collection_names
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_BATCH_SIZE = 50000
+# files starting with an underscore are ignored by Parquet dataset readers
+EXPORT_STATE_FILE = '_export_state.json'
+# subtracted from the start of an export to get the point from which the next incremental export starts
+EXPORT_WATERMARK_MARGIN = timedelta(minutes=10)
+
+# tool result fields and the parts of them needed for the export (patches, refactoring locations etc. are not transferred)
+TOOL_FIELDS: Dict[str, List[str]] = {
+    'message': [],
+    'conventional_commit': [],
+    'files': ['filename', 'status'],
+    'refactoring_miner/2_1_0': ['status', 'refactorings.type'],
+}
+LABEL_FIELDS = ['manual_labels', 'bohr', 'idan/0_1']
+
+
+def get_projection(fields: Dict[str, List[str]], prefix: str = '') -> Dict[str, int]:
+    """
+    >>> get_projection({'message': [], 'files': ['filename']})
+    {'message': 1, 'files.filename': 1, 'files._codec': 1, 'files.size': 1, 'files.data': 1, 'files.key': 1, 'files.chunks': 1}
+    """
+    projection = {}
+    for field, subfields in fields.items():
+        if not subfields:
+            projection[prefix + field] = 1
+        else:
+            for subfield in subfields + CODEC_FIELDS:
+                projection[f'{prefix}{field}.{subfield}'] = 1
+    return projection
+
+
+def flatten(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    >>> flatten({'_id': 'abc', 'owner': 'a', 'repo': 'b', 'message': 'fix: x', 'conventional_commit': {'type': 'fix', 'conventional': True},
+    ...          'files': [{'filename': 'a.py', 'status': 'modified'}, {'filename': 'b.py', 'status': 'added'}],
+    ...          'refactoring_miner/2_1_0': {'status': 'ok', 'refactorings': [{'type': 'Rename Method'}]},
+    ...          'manual_labels': {'herzig': {'bug': 1, 'label': None}}, 'bohr': {'200k_commits': True}})
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'sha': 'abc', 'owner': 'a', 'repo': 'b', 'url': None, 'updated_at': None, 'message': 'fix: x',
+     'conventional': True, 'conventional_type': 'fix',
+     'n_files': 2, 'n_added_files': 1, 'n_removed_files': 0, 'n_modified_files': 1, 'n_renamed_files': 0, 'filenames': ['a.py', 'b.py'],
+     'refactoring_status': 'ok', 'refactoring_types': ['Rename Method'],
+     'bohr_200k_commits': True, 'labels': [('herzig.bug', '1')]}
+    """
+    row = {
+        'sha': doc['_id'],
+        'owner': doc.get('owner'),
+        'repo': doc.get('repo'),
+        'url': doc.get('url'),
+        'updated_at': doc.get('updated_at'),
+        'message': doc.get('message') if isinstance(doc.get('message'), str) else None,
+    }
+
+    conventional_commit = doc.get('conventional_commit') or {}
+    row['conventional'] = conventional_commit.get('conventional')
+    row['conventional_type'] = conventional_commit.get('type')
+
+    files = doc.get('files')
+    if isinstance(files, list):
+        statuses = [file.get('status') for file in files]
+        row['n_files'] = len(files)
+        for status in ['added', 'removed', 'modified', 'renamed']:
+            row[f'n_{status}_files'] = statuses.count(status)
+        row['filenames'] = [file.get('filename') for file in files]
+    else:
+        row.update({'n_files': None, 'n_added_files': None, 'n_removed_files': None, 'n_modified_files': None,
+                    'n_renamed_files': None, 'filenames': None})
+
+    refactorings = doc.get('refactoring_miner/2_1_0') or {}
+    row['refactoring_status'] = refactorings.get('status')
+    row['refactoring_types'] = [r.get('type') for r in refactorings['refactorings']] if 'refactorings' in refactorings else None
+
+    row['bohr_200k_commits'] = (doc.get('bohr') or {}).get('200k_commits')
+    labels = []
+    label_sets = {**(doc.get('manual_labels') or {}), 'idan': doc.get('idan/0_1') or {}}
+    for label_set, values in label_sets.items():
+        if isinstance(values, dict):
+            labels.extend((f'{label_set}.{key}', str(value)) for key, value in values.items() if value is not None)
+        elif values is not None:
+            labels.append((label_set, str(values)))
+    row['labels'] = labels
+    return row
+
+
+def get_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('sha', pa.string()),
+        ('owner', pa.string()),
+        ('repo', pa.string()),
+        ('url', pa.string()),
+        ('updated_at', pa.timestamp('ms')),
+        ('message', pa.string()),
+        ('conventional', pa.bool_()),
+        ('conventional_type', pa.string()),
+        ('n_files', pa.int32()),
+        ('n_added_files', pa.int32()),
+        ('n_removed_files', pa.int32()),
+        ('n_modified_files', pa.int32()),
+        ('n_renamed_files', pa.int32()),
+        ('filenames', pa.list_(pa.string())),
+        ('refactoring_status', pa.string()),
+        ('refactoring_types', pa.list_(pa.string())),
+        ('bohr_200k_commits', pa.bool_()),
+        ('labels', pa.map_(pa.string(), pa.string())),
+    ])
+
+
+def iter_export_batches(database, query: Dict[str, Any], batch_size: int = EXPORT_BATCH_SIZE, with_field: Optional[str] = None,
+                        layout: str = STORAGE_LAYOUT) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    Streams commits matching `query` in batches of `batch_size`, only the fields needed for the export are fetched.
+    In the `per_tool` layout, tool results are looked up in the tool collections for each batch,
+    and, if `with_field` is a tool, commits without its results are skipped.
+    """
+    tool_collections = set(get_tool_collection_names(database)) if layout == STORAGE_LAYOUT_PER_TOOL else set()
+    joined_fields = {field: subfields for field, subfields in TOOL_FIELDS.items() if tool_collection_name(field) in tool_collections}
+    projection = {'owner': 1, 'repo': 1, 'url': 1, 'updated_at': 1, **{field: 1 for field in LABEL_FIELDS},
+                  **get_projection({field: subfields for field, subfields in TOOL_FIELDS.items() if field not in joined_fields})}
+    if with_field is not None and with_field not in joined_fields:
+        query = {**query, with_field: {'$exists': True}}
+    cursor = database.commits.find(query, projection).batch_size(min(batch_size, 10000))
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        if joined_fields:
+            commits = {doc['_id']: doc for doc in batch}
+            for field, subfields in joined_fields.items():
+                tool_projection = get_projection({'result': subfields})
+                for doc in database[tool_collection_name(field)].find({'_id': {'$in': list(commits.keys())}}, tool_projection):
+                    commits[doc['_id']][field] = doc['result']
+            if with_field in joined_fields:
+                batch = [doc for doc in batch if with_field in doc]
+        yield [decode_document(doc, database) for doc in batch]
+
+
+def read_export_state(output_dir: Path) -> Dict[str, Any]:
+    path = output_dir / EXPORT_STATE_FILE
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def write_export_state(output_dir: Path, state: Dict[str, Any]) -> None:
+    with (output_dir / EXPORT_STATE_FILE).open('w') as f:
+        json.dump(state, f, indent=2)
+
+
+def export_to_parquet(database, output_dir: Path, with_field: Optional[str] = None, incremental: bool = False,
+                      batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """
+    Writes commits to `output_dir/run=<timestamp>/part-<n>.parquet` (zstd-compressed), one file per batch,
+    so that memory usage does not depend on the number of exported commits.
+    With `incremental`, only commits updated after the start of the previous export (minus `EXPORT_WATERMARK_MARGIN`)
+    are written. Commits updated around the start of an export can therefore be written by two runs,
+    readers should keep the row of the latest run for each sha.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state = read_export_state(output_dir)
+    query = {}
+    if incremental and 'last_updated_at' in state:
+        query['updated_at'] = {'$gt': datetime.fromisoformat(state['last_updated_at'])}
+        logger.info(f'Exporting commits updated after {state["last_updated_at"]}')
+
+    schema = get_schema()
+    started_at = datetime.utcnow()
+    run_dir = output_dir / f'run={started_at.strftime("%Y%m%dT%H%M%S%f")}'
+    n_exported = 0
+    for i, batch in enumerate(iter_export_batches(database, query, batch_size, with_field)):
+        rows = [flatten(doc) for doc in batch]
+        run_dir.mkdir(exist_ok=True)
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), run_dir / f'part-{i:05d}.parquet', compression='zstd')
+        n_exported += len(rows)
+        logger.info(f'Exported {n_exported} commits')
+
+    # The cursor is not sorted by updated_at, so the newest value seen is not a safe watermark: commits written during
+    # the export may have an older updated_at than one already read. The start of the export is, apart from clock skew
+    # between this machine and the database and writes that were in flight, which the margin accounts for.
+    state['last_updated_at'] = (started_at - EXPORT_WATERMARK_MARGIN).isoformat()
+    write_export_state(output_dir, state)
+    return n_exported
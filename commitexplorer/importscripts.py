@@ -1,12 +1,100 @@
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 
 import pandas as pd
-import pymongo
 import requests
 from pymongo import MongoClient, UpdateOne
-from pymongo.results import UpdateResult
 from tqdm import tqdm
 
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.indexes import sync_indexes
+from commitexplorer.stats import refresh_stats
+
+
+IMPORT_CHUNK_SIZE = 10000
+IMPORT_BATCH_SIZE = 1000
+
+
+def column_values(df: pd.DataFrame, column: str) -> List[Any]:
+    """
+    Returns values of the column as Python objects, NaN values are replaced with None.
+
+    >>> column_values(pd.DataFrame({'a': [1, None, 3]}), 'a')
+    [1.0, None, 3.0]
+    >>> column_values(pd.DataFrame({'a': [1, 2]}), 'b')
+    [None, None]
+    """
+    if column not in df:
+        return [None] * len(df)
+    series = df[column]
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def set_documents(fields: Dict[str, List[Any]], skip_none: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """
+    Assembles `$set` documents from columns.
+
+    >>> set_documents({'message': ['a', 'b'], 'owner': ['o', None]}, skip_none=['owner'])
+    [{'message': 'a', 'owner': 'o'}, {'message': 'b'}]
+    """
+    skip_none = set(skip_none)
+    names = list(fields.keys())
+    return [{name: value for name, value in zip(names, values) if value is not None or name not in skip_none}
+            for values in zip(*fields.values())]
+
+
+def records(df: pd.DataFrame, columns: List[str]) -> List[Dict[str, Any]]:
+    """
+    >>> records(pd.DataFrame({'bug': [1, 0], 'label': ['x', None]}), ['bug', 'label'])
+    [{'bug': 1, 'label': 'x'}, {'bug': 0, 'label': None}]
+    """
+    return set_documents({column: column_values(df, column) for column in columns})
+
+
+def new_import_stats() -> Dict[str, int]:
+    return {'operations': 0, 'matched': 0, 'modified': 0, 'upserted': 0}
+
+
+def write_updates(collection, ids: List[Any], updates: List[Dict[str, Any]], stats: Dict[str, int],
+                  upsert: bool = True, batch_size: int = IMPORT_BATCH_SIZE) -> None:
+    for i in range(0, len(ids), batch_size):
+        # updated_at marks documents as changed for incremental exports and cached server responses
+        operations = [UpdateOne({'_id': id}, {**update, '$currentDate': {UPDATED_AT: True}}, upsert=upsert)
+                      for id, update in zip(ids[i:i + batch_size], updates[i:i + batch_size])]
+        result = collection.bulk_write(operations, ordered=False)
+        stats['operations'] += len(operations)
+        stats['matched'] += result.matched_count
+        stats['modified'] += result.modified_count
+        stats['upserted'] += result.upserted_count
+
+
+def import_in_chunks(path_or_buffer, collection, to_updates: Callable[[pd.DataFrame], Tuple[List[Any], List[Dict[str, Any]]]],
+                     chunk_size: int = IMPORT_CHUNK_SIZE, batch_size: int = IMPORT_BATCH_SIZE, **read_csv_kwargs) -> Dict[str, int]:
+    """
+    Reads the CSV in chunks of `chunk_size` rows, `to_updates` turns a chunk into ids and update documents,
+    which are written with unordered bulk writes of at most `batch_size` operations,
+    so memory usage does not depend on the size of the file.
+    """
+    stats = new_import_stats()
+    for chunk in tqdm(pd.read_csv(path_or_buffer, chunksize=chunk_size, **read_csv_kwargs), desc=f'Importing to {collection.name}'):
+        ids, updates = to_updates(chunk)
+        write_updates(collection, ids, updates, stats, batch_size=batch_size)
+    print_import_stats(collection.name, stats)
+    return stats
+
+
+def print_import_stats(name: str, stats: Dict[str, int]) -> None:
+    print(f"{name}: {stats['operations']} updates, {stats['matched']} matched, {stats['modified']} modified, {stats['upserted']} upserted")
+
+
+def commit_set_documents(chunk: pd.DataFrame, fields: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    return [{'$set': doc} for doc in set_documents({
+        'message': column_values(chunk, 'message'),
+        'owner': column_values(chunk, 'owner'),
+        'repo': column_values(chunk, 'repository'),
+        **fields
+    }, skip_none=['owner', 'repo'])]
+
 
 def import_levin(path, database):
     import_csv(path, 'levin', ['bug', 'label', 'ADDING_ATTRIBUTE_MODIFIABILITY', 'ADDING_CLASS_DERIVABILITY',
@@ -46,139 +134,134 @@ def import_krasniqi(path, database):
 
 
 def import_bohr_manual_label_hlib(path_labels, path_commits, database):
-    operations = []
-    commits = pd.read_csv(path_commits)
-    links = pd.read_csv(path_labels)
-    merged = pd.merge(commits, links, on='commit_id')
-    for row in merged.iterrows():
-        update = {'$set': {'manual_labels.bohr.hlib': {'label': row[1]['label'],
-                           'note': row[1]['note'] if not pd.isna(row[1]['note']) else None,
-                           'certainty': row[1]['certainty'] if not pd.isna(row[1]['certainty']) else None,
-                           'showcase': True if not pd.isna(row[1]['showcase']) and row[1]['showcase'] else False}}}
-        operations.append(UpdateOne({"_id": row[1]['sha']}, update, upsert=True))
-    database.commits.bulk_write(operations)
+    commits = pd.read_csv(path_commits, usecols=['commit_id', 'sha'])
+
+    def to_updates(chunk):
+        merged = pd.merge(commits, chunk, on='commit_id')
+        showcase = merged['showcase'].fillna(False).astype(bool).tolist() if 'showcase' in merged else [False] * len(merged)
+        labels = set_documents({
+            'label': column_values(merged, 'label'),
+            'note': column_values(merged, 'note'),
+            'certainty': column_values(merged, 'certainty'),
+            'showcase': showcase,
+        })
+        return column_values(merged, 'sha'), [{'$set': {'manual_labels.bohr.hlib': label}} for label in labels]
+
+    return import_in_chunks(path_labels, database.commits, to_updates)
+
+
+def get_issue_ids(df: pd.DataFrame) -> List[str]:
+    """
+    >>> get_issue_ids(pd.DataFrame({'owner': ['a'], 'repository': ['b'], 'identifier': ['#1']}))
+    ['github://a/b#1']
+    """
+    return [f'github://{owner}/{repository}{identifier}' for owner, repository, identifier
+            in zip(df['owner'].tolist(), df['repository'].tolist(), df['identifier'].tolist())]
 
 
 def import_200k_issues(path_issues, path_commits, path_links, database):
-    operations = []
-    operations_issues = []
-    columns = ['title', 'body', 'labels']
-    issues = pd.read_csv(path_issues)
-    commits = pd.read_csv(path_commits)
-    links = pd.read_csv(path_links)
-    merged = pd.merge(pd.merge(commits, links, on='commit_id'), issues, on='issue_id')
-    for row in merged.iterrows():
-        update1 = {'$set': {column: row[1][column] if not pd.isna(row[1][column]) else None for column in columns}}
-        id = f'github://{row[1]["owner_y"]}/{row[1]["repository_y"]}{row[1]["identifier"]}'
-        operations_issues.append(UpdateOne({"_id": id}, update1, upsert=True))
-        update = {'$set': {"links.bohr.issues": [id]}}
-        operations.append(UpdateOne({"_id": row[1]['sha_x']}, update, upsert=True))
-
-    database.issues.bulk_write(operations_issues)
-    database.commits.bulk_write(operations)
+    # only the columns needed to join the files are kept in memory, issues and links are streamed in chunks
+    commits = pd.read_csv(path_commits, usecols=['commit_id', 'sha'])
+    issues = pd.read_csv(path_issues, usecols=['issue_id', 'owner', 'repository', 'identifier'])
+    issues = pd.DataFrame({'issue_id': issues['issue_id'], 'id': get_issue_ids(issues)})
+    linked_issue_ids = set(pd.read_csv(path_links, usecols=['issue_id'])['issue_id'].tolist())
+
+    def issue_updates(chunk):
+        chunk = chunk[chunk['issue_id'].isin(linked_issue_ids)]
+        return get_issue_ids(chunk), [{'$set': doc} for doc in records(chunk, ['title', 'body', 'labels'])]
+
+    import_in_chunks(path_issues, database.issues, issue_updates)
+
+    def link_updates(chunk):
+        merged = pd.merge(pd.merge(commits, chunk[['commit_id', 'issue_id']], on='commit_id'), issues, on='issue_id')
+        return column_values(merged, 'sha'), [{'$set': {"links.bohr.issues": [id]}} for id in merged['id'].tolist()]
+
+    return import_in_chunks(path_links, database.commits, link_updates)
 
 
 def import_200k(path_commits, path_files, database):
-    operations = []
-    commits = pd.read_csv(path_commits)
-    for row in commits.iterrows():
-        update = {'$set': {"message": row[1]['message'], "bohr.200k_commits": True}, '$unset': {"files": ""}}
-        if 'owner' in row[1] and not pd.isna(row[1]['owner']):
-            update['$set']['owner'] = row[1]['owner']
-        if 'repository' in row[1] and not pd.isna(row[1]['repository']):
-            update['$set']['repo'] = row[1]['repository']
-        operations.append(UpdateOne({"_id": row[1]['sha']}, update, upsert=True))
-    files = pd.read_csv(path_files)
-    merged = pd.merge(files, commits, on='commit_id')
+    def commit_updates(chunk):
+        updates = commit_set_documents(chunk, {'bohr.200k_commits': [True] * len(chunk)})
+        for update in updates:
+            update['$unset'] = {'files': ''}
+        return column_values(chunk, 'sha'), updates
+
+    stats = import_in_chunks(path_commits, database.commits, commit_updates)
+
+    commits = pd.read_csv(path_commits, usecols=['commit_id', 'sha'])
     columns_to_add = ['filename', 'status', 'previous_filename', 'patch', 'change']
-    for row in merged.iterrows():
-        if not pd.isna(row[1]['filename']):
-            update = {'$push': {"files": {name: row[1][name] for name in columns_to_add if not pd.isna(row[1][name])}}}
-            operations.append(UpdateOne({"_id": row[1]['sha']}, update, upsert=True))
-        else:
-            print(f'NaN: {row[1]["sha"]}')
 
-    database.commits.bulk_write(operations)
+    def file_updates(chunk):
+        merged = pd.merge(chunk, commits, on='commit_id')
+        missing_filename = merged['filename'].isna()
+        for sha in merged.loc[missing_filename, 'sha'].tolist():
+            print(f'NaN: {sha}')
+        merged = merged[~missing_filename]
+        files_by_sha: Dict[str, List[Dict[str, Any]]] = {}
+        for sha, file in zip(merged['sha'].tolist(), records(merged, columns_to_add)):
+            files_by_sha.setdefault(sha, []).append({name: value for name, value in file.items() if value is not None})
+        # files of one commit are pushed with a single operation, so their order is preserved in unordered bulk writes
+        return list(files_by_sha.keys()), [{'$push': {'files': {'$each': files}}} for files in files_by_sha.values()]
+
+    import_in_chunks(path_files, database.commits, file_updates)
+    return stats
 
 
 def import_herzig_tangled(database):
     a = requests.get('https://raw.githubusercontent.com/kimherzig/untangling_changes/master/atomic_fixes/jruby/jruby_atomic_fixes.csv')
     atomic_shas = a.text.split('\n')
-    count = 0
-    for sha in atomic_shas:
-        update_result = database.commits.update_one({'_id': sha}, {"$set": {"manual_labels.herzig_tangled.tangled": False}})
-        if update_result.raw_result['n'] == 1:
-            count += 1
-        else:
-            print(f'Not foudn sha: {sha}')
-
-    print(f'Set {count} out of {len(atomic_shas)} atomic commits')
+    stats = new_import_stats()
+    write_updates(database.commits, atomic_shas, [{"$set": {"manual_labels.herzig_tangled.tangled": False}}] * len(atomic_shas), stats, upsert=False)
+    print(f"Set {stats['matched']} out of {len(atomic_shas)} atomic commits")
 
     b = requests.get('https://raw.githubusercontent.com/kimherzig/untangling_changes/master/obvious_blobs/jruby/jruby_obvious_blobs.csv')
     lines = b.text.split('\n')[1:]
     blob_shas = [line.split(',')[0] for line in lines]
-    count_blobs = 0
-    for sha in blob_shas:
-        update_result = database.commits.update_one({'_id': sha}, {"$set": {"manual_labels.herzig_tangled.tangled": True}})
-        if update_result.raw_result['n'] == 1:
-            count_blobs += 1
+    stats = new_import_stats()
+    write_updates(database.commits, blob_shas, [{"$set": {"manual_labels.herzig_tangled.tangled": True}}] * len(blob_shas), stats, upsert=False)
+    print(f"Set {stats['matched']} out of {len(blob_shas)} tangled commits")
 
-    print(f'Set {count_blobs} out of {len(blob_shas)} tangled commits')
 
+def import_csv(path, name, columns, database):
+    def to_updates(chunk):
+        fields = {f'manual_labels.{name}': records(chunk, columns)} if len(columns) > 0 else {}
+        return column_values(chunk, 'sha'), commit_set_documents(chunk, fields)
 
+    return import_in_chunks(path, database.commits, to_updates)
 
-def import_csv(path, name, columns, database):
-    df = pd.read_csv(path)
-    operations = []
-    for row in df.iterrows():
-        update = {'$set': {"message": row[1]['message']}}
-        if 'owner' in row[1] and not pd.isna(row[1]['owner']):
-            update['$set']['owner'] = row[1]['owner']
-        if 'repository' in row[1] and not pd.isna(row[1]['repository']):
-            update['$set']['repo'] = row[1]['repository']
-        if len(columns) > 0:
-            update['$set']["manual_labels"] = {name: {l: row[1][l] for l in columns}}
-        operations.append(UpdateOne({"_id": row[1]['sha']}, update, upsert=True))
-    print(f"Writing {len(operations)} records to db ...")
-    database.commits.bulk_write(operations)
+
+def str_to_bool(s):
+    """
+    >>> [str_to_bool(s) for s in ['TRUE', True, 'flase', 'FALSE', False, None]]
+    [True, True, False, False, False, None]
+    """
+    if s is None:
+        return None
+    if s in ['TRUE', True]:
+        return True
+    elif s in ['flase', 'FALSE', False]:
+        return False
+    else:
+        raise ValueError(f'{s}')
 
 
 def import_idan(database):
+    import dvc.api
+
+    def to_updates(chunk):
+        chunk = chunk[chunk['Is_Refactor'].astype(str) != 'nan']
+        owners_and_repos = [repo_name.split('/') for repo_name in chunk['repo_name'].tolist()]
+        labels = set_documents({
+            **{field: [str_to_bool(value) for value in column_values(chunk, field)]
+               for field in ['Is_Refactor', 'Is_Perfective', 'Is_Adaptive', 'Is_Corrective']},
+            **{field: column_values(chunk, field) for field in ['Justification', 'Comment']},
+        }, skip_none=['Is_Refactor', 'Is_Perfective', 'Is_Adaptive', 'Is_Corrective', 'Justification', 'Comment'])
+        updates = [{'$set': {'message': message, 'owner': owner, 'repo': repo, 'idan/0_1': label}}
+                   for message, (owner, repo), label in zip(column_values(chunk, 'message'), owners_and_repos, labels)]
+        return column_values(chunk, 'commit'), updates
+
     with dvc.api.open('data/random_batch_18_nov_2020.csv', repo='https://github.com/evidencebp/commit-classification', rev='bfffa8700f6263719d52db979ef9d235c974a543') as f:
-        df = pd.read_csv(f)
-    df = df[df['Is_Refactor'].astype(str) != 'nan']
-
-    operations = []
-
-    def str_to_bool(s):
-        if s in ['TRUE', True]:
-            return True
-        elif s in ['flase', 'FALSE', False]:
-            return False
-        else:
-            raise ValueError(f'{s}')
-
-
-    for _, item in tqdm(df.iterrows()):
-        owner, repo = item['repo_name'].split('/')
-        update = {'$set': {
-            'message': item['message'],
-            'owner': owner,
-            'repo': repo,
-            'idan/0_1': {},
-        }}
-        fields = ['Is_Refactor', 'Is_Perfective', 'Is_Adaptive', 'Is_Corrective']
-        for field in fields:
-            if not pd.isna(item[field]):
-                update['$set']['idan/0_1'][field] = str_to_bool(item[field])
-        fields_str = ['Justification', 'Comment']
-        for field in fields_str:
-            if not pd.isna(item[field]):
-                update['$set']['idan/0_1'][field] = item[field]
-        operations.append(UpdateOne({"_id": item['commit']}, update, upsert=True))
-
-
-    database.bulk_write(operations)
+        return import_in_chunks(f, database.commits, to_updates)
 
 
 def import_all():
@@ -205,14 +288,9 @@ def import_all():
     # import_200k_issues(path_to_200k_commits_issues, path_to_200k_commits, path_to_200k_commits_link_issues, database)
     # import_bohr_manual_label_hlib(path_to_200k_commits_manual_labels, path_to_200k_commits, database)
 
-    database.commits.create_index([("bohr.200k_commits", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.berger", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.herzig", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.levin", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.krasniqi", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.import_mauczka", pymongo.ASCENDING)])
-    database.commits.create_index([("manual_labels.manual_labels.bohr.hlib", pymongo.ASCENDING)])
-    database.commits.create_index([("idan/0_1", pymongo.ASCENDING)])
+    sync_indexes(database)
+    # imported labels do not mark projects as dirty
+    refresh_stats(database, full=True)
 
 
 if __name__ == '__main__':
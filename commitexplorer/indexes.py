@@ -0,0 +1,145 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    collection: str
+    keys: Tuple[Tuple[str, int], ...]
+    name: str
+    sparse: bool = False
+    partial_filter: Optional[Dict[str, Any]] = field(default=None, hash=False)
+
+    def options(self) -> Dict[str, Any]:
+        options = {'name': self.name}
+        if self.sparse:
+            options['sparse'] = True
+        if self.partial_filter is not None:
+            options['partialFilterExpression'] = self.partial_filter
+        return options
+
+    def matches(self, index_info: Dict[str, Any]) -> bool:
+        """
+        >>> spec = IndexSpec('commits', (('owner', pymongo.ASCENDING), ('repo', pymongo.ASCENDING)), 'owner_repo')
+        >>> spec.matches({'key': [('owner', 1), ('repo', 1)], 'v': 2})
+        True
+        >>> spec.matches({'key': [('owner', 1)], 'v': 2})
+        False
+        """
+        return (tuple((k, int(v)) for k, v in index_info['key']) == self.keys
+                and index_info.get('sparse', False) == self.sparse
+                and index_info.get('partialFilterExpression') == self.partial_filter)
+
+
+COLLECTIONS = ['commits', 'runs', 'issues']
+
+TOOL_RESULT_FIELDS = [
+    'refactoring_miner/2_1_0',
+    'gumtree/3_0_0-beta2',
+    'special_commit_finder/0_1',
+    'mine_sstubs/head',
+    'mine_sstubs_chunked/head',
+    'spacy/0_1',
+    'files',
+    'conventional_commit',
+    'message',
+    'message_cleaner',
+]
+
+LABEL_FIELDS = [
+    'bohr.200k_commits',
+    'manual_labels.berger',
+    'manual_labels.herzig',
+    'manual_labels.levin',
+    'manual_labels.krasniqi',
+    'manual_labels.mauczka',
+    'manual_labels.bohr.hlib',
+    'manual_labels.herzig_tangled.tangled',
+    'idan/0_1',
+]
+
+
+def tool_result_index_name(tool_field: str) -> str:
+    return f'tool__{tool_field}'
+
+
+def tool_result_index(tool_field: str) -> IndexSpec:
+    # Indexing the tool field itself would copy whole tool outputs into the index. Instead, the index only covers
+    # commits that have the result (partial filter) and is keyed by _id, so that `{_id: {$in: ...}, <tool>: {$exists: true}}`
+    # queries are index-backed. `{<tool>: {$exists: true}}` queries have no predicate on a key of the index, the planner
+    # only uses it if it is hinted (see `commitexplorer.db.get_field_query`); the partial filter makes a scan of the whole
+    # index return exactly the commits with the result, sorted by _id. The small `status` subfield keeps key patterns
+    # distinct (an index on {_id: 1} alone would be an _id index, which cannot be partial).
+    return IndexSpec('commits', (('_id', pymongo.ASCENDING), (f'{tool_field}.status', pymongo.ASCENDING)),
+                     tool_result_index_name(tool_field), partial_filter={tool_field: {'$exists': True}})
+
+
+INDEX_SPEC: List[IndexSpec] = [
+    IndexSpec('commits', (('owner', pymongo.ASCENDING), ('repo', pymongo.ASCENDING)), 'owner_repo'),
+    IndexSpec('commits', (('url', pymongo.ASCENDING),), 'url', sparse=True),
+    IndexSpec('commits', (('links.bohr.issues', pymongo.ASCENDING),), 'links_bohr_issues', sparse=True),
+    IndexSpec('commits', (('updated_at', pymongo.ASCENDING),), 'updated_at', sparse=True),
+    *[IndexSpec('commits', ((label_field, pymongo.ASCENDING),), f'label__{label_field}', sparse=True) for label_field in LABEL_FIELDS],
+    *[tool_result_index(tool_field) for tool_field in TOOL_RESULT_FIELDS],
+]
+
+
+def sync_indexes(database, drop_unknown: bool = False) -> Dict[str, List[str]]:
+    """
+    Creates indexes from INDEX_SPEC that are missing, recreates the ones whose definition has changed
+    and, if `drop_unknown` is set, drops indexes that are not in the spec.
+    """
+    report = {'created': [], 'recreated': [], 'dropped': [], 'unchanged': []}
+    for collection in COLLECTIONS:
+        existing = database[collection].index_information()
+        specs = [spec for spec in INDEX_SPEC if spec.collection == collection]
+        for spec in specs:
+            if spec.name in existing:
+                if spec.matches(existing[spec.name]):
+                    report['unchanged'].append(f'{collection}.{spec.name}')
+                    continue
+                logger.info(f'Index {collection}.{spec.name} has changed, recreating it ...')
+                database[collection].drop_index(spec.name)
+                report['recreated'].append(f'{collection}.{spec.name}')
+            else:
+                logger.info(f'Creating index {collection}.{spec.name} ...')
+                report['created'].append(f'{collection}.{spec.name}')
+            database[collection].create_index(list(spec.keys), **spec.options())
+        if drop_unknown:
+            spec_names = {spec.name for spec in specs}
+            for name in existing:
+                if name != '_id_' and name not in spec_names:
+                    logger.info(f'Dropping index {collection}.{name} ...')
+                    database[collection].drop_index(name)
+                    report['dropped'].append(f'{collection}.{name}')
+    return report
+
+
+def index_status(database) -> List[Dict[str, Any]]:
+    """
+    Lists existing and missing indexes with their size and the number of times they were used since the server started.
+    """
+    rows = []
+    for collection in COLLECTIONS:
+        sizes = database.command('collStats', collection).get('indexSizes', {})
+        usage = {stat['name']: stat['accesses']['ops'] for stat in database[collection].aggregate([{'$indexStats': {}}])}
+        existing = database[collection].index_information()
+        specs = {spec.name: spec for spec in INDEX_SPEC if spec.collection == collection}
+        for name, info in existing.items():
+            rows.append({
+                'collection': collection,
+                'name': name,
+                'size': sizes.get(name, 0),
+                'ops': usage.get(name, 0),
+                'managed': name == '_id_' or name in specs,
+                'up_to_date': name == '_id_' or (name in specs and specs[name].matches(info)),
+            })
+        for name in specs:
+            if name not in existing:
+                rows.append({'collection': collection, 'name': name, 'size': 0, 'ops': 0, 'managed': True, 'up_to_date': False, 'missing': True})
+    return rows
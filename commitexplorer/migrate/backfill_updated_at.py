@@ -0,0 +1,30 @@
+from typing import Any, Dict
+
+from pymongo import UpdateOne
+
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.migrate.runner import Migration
+
+
+class BackfillCommitsUpdatedAt(Migration):
+    # documents written before `updated_at` was introduced have no version, so the server neither caches nor tags them;
+    # backfilled documents are exported once more by the next incremental export
+    query = {UPDATED_AT: {'$exists': False}}
+    projection = {'_id': 1}
+
+    def migrate(self, doc: Dict[str, Any]) -> UpdateOne:
+        # documents written in the meantime already have a newer version
+        return UpdateOne({'_id': doc['_id'], UPDATED_AT: {'$exists': False}}, {'$currentDate': {UPDATED_AT: True}})
+
+
+class BackfillIssuesUpdatedAt(BackfillCommitsUpdatedAt):
+    collection = 'issues'
+    # issue ids are urls, not shas
+    split_by_sha = False
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('backfill_commits_updated_at')
+    MigrationRunner(get_db()).run('backfill_issues_updated_at')
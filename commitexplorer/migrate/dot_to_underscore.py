@@ -1,27 +1,44 @@
-# Requires the PyMongo package.
-# https://api.mongodb.com/python/current
-
-from pymongo import MongoClient
-
-client = MongoClient('mongodb://10.10.20.160:27017/?readPreference=primary&appname=MongoDB%20Compass&directConnection=true&ssl=false')
-result = client['commit_explorer']['commits'].update_many({'$expr': {'$ne': [
-    {
-        '$getField': "refactoring_miner/2.1.0"
-    }, None
-]}}, [
-    {
-        '$set': {
-            "refactoring_miner/2_1_0": {
-                '$getField': "refactoring_miner/2.1.0"
-            }
-        }
-    }, {
-        '$replaceWith': {
-            '$setField': {
-                'field': "refactoring_miner/2.1.0",
-                'input': '$$CURRENT',
-                'value': '$$REMOVE'
+from typing import Any, Dict
+
+from pymongo import UpdateOne
+
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.migrate.runner import Migration
+
+OLD_FIELD = 'refactoring_miner/2.1.0'
+NEW_FIELD = 'refactoring_miner/2_1_0'
+
+
+class DotToUnderscore(Migration):
+    # field names with dots can only be accessed with $getField (MongoDB 5.0+)
+    query = {'$expr': {'$ne': [{'$getField': OLD_FIELD}, None]}}
+    projection = {'_id': 1}
+
+    def migrate(self, doc: Dict[str, Any]) -> UpdateOne:
+        return UpdateOne({'_id': doc['_id']}, [
+            {
+                '$set': {
+                    NEW_FIELD: {
+                        '$getField': OLD_FIELD
+                    }
+                }
+            }, {
+                '$replaceWith': {
+                    '$setField': {
+                        'field': OLD_FIELD,
+                        'input': '$$CURRENT',
+                        'value': '$$REMOVE'
+                    }
+                }
+            }, {
+                '$set': {
+                    UPDATED_AT: '$$NOW'
+                }
             }
-        }
-    }
-])
+        ])
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('dot_to_underscore')
@@ -0,0 +1,32 @@
+from typing import Any, Dict, List
+
+from pymongo import UpdateOne
+
+from commitexplorer.db import tool_collection_name, save_tool_results, UPDATED_AT
+from commitexplorer.indexes import TOOL_RESULT_FIELDS
+from commitexplorer.migrate.runner import Migration
+
+
+class EmbeddedToPerTool(Migration):
+    # moves tool results from documents of the `commits` collection to the tools' collections
+    query = {'$or': [{field: {'$exists': True}} for field in TOOL_RESULT_FIELDS]}
+    projection = {field: 1 for field in TOOL_RESULT_FIELDS}
+
+    def migrate(self, doc: Dict[str, Any]) -> UpdateOne:
+        return UpdateOne({'_id': doc['_id']}, {'$unset': {field: '' for field in TOOL_RESULT_FIELDS if field in doc},
+                                               '$currentDate': {UPDATED_AT: True}})
+
+    def migrate_batch(self, database, docs: List[Dict[str, Any]]) -> int:
+        # results are written to the tool collections before they are unset in `commits`,
+        # so a batch interrupted in between is simply moved again when the migration is resumed
+        for field in TOOL_RESULT_FIELDS:
+            results = [(doc['_id'], doc[field]) for doc in docs if field in doc]
+            if results:
+                save_tool_results(database[tool_collection_name(field)], results)
+        return super().migrate_batch(database, docs)
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('embedded_to_per_tool')
@@ -1,21 +1,27 @@
 import json
+import logging
 import os
 from json.decoder import JSONDecodeError
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Set, Tuple
 
-from commitexplorer.cli import db
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DocumentTooLarge, WriteError
+from tqdm import tqdm
 
+from commitexplorer import project_root
+from commitexplorer.cli import get_db
+from commitexplorer.codec import encode_value, ENCODE_THRESHOLD
+from commitexplorer.common import Sha
+from commitexplorer.db import UPDATED_AT
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_SIZE = 1000
+CHECKPOINT_PATH = project_root / 'fs_to_mongo.checkpoint'
 
-def remove_large_values(dct: Dict) -> Dict:
-    res = {}
-    for key, value in dct.items():
-        if len(json.dumps(value).encode('utf-8')) > 1024 * 1024 * 10:
-            print(f'Omitting {key}')
-            res[key] = {'status': 'value-too-large'}
-        else:
-            res[key] = value
-    return res
 
 
 def validate_and_fix_tool_ids(commit_document: Dict) -> Dict:
@@ -76,52 +82,149 @@ def check_no_dots_and_dollars_in_keys(dct: Dict) -> None:
             check_no_dots_and_dollars_in_keys(value)
 
 
-def save_commits_from_fs_to_db(database):
-    storage_path = os.environ['COMMIT_EXPLORER_STORAGE']
-    for dirpath, dirnames, filenames in os.walk(storage_path):
-        for file in filenames:
-            path = Path(dirpath) / file
-            with path.open() as f:
-                try:
-                    dct = json.loads(f.read())
-                except JSONDecodeError:
-                    print(f"File {path} is corrupted. Skipping")
-                    continue
-
-                sha = str(path.parent.parent.name) + str(path.parent.name) + str(path.name)
-                if len(sha) != 40:
-                    raise AssertionError(sha)
-
-                dct = validate_and_fix_tool_ids(dct)
-                check_no_dots_and_dollars_in_keys(dct)
-                dct = remove_large_values(dct)
-                try:
-                    to_insert = {'_id': sha, **dct}
-                    from_db = database.commits.find_one({'_id': sha})
-                    if from_db is None:
-                        print(f"looked up for commit {sha} in the database, result: {from_db}")
-                        database.commits.insert_one(to_insert)
-                        print(f"Inserting {to_insert}")
-                        print()
-                    else:
-                        update_needed = False
-                        for key, value in to_insert.items():
-                            if key not in from_db:
-                                from_db[key] = value
-                                print(f"New key: {key}")
-                                update_needed = True
-                        if update_needed:
-                            database.commits.replace_one({'_id': sha}, from_db)
-                            print(f"Updated: {sha}")
-
-                except Exception as ex:
-                    print(f"Exception: {type(ex).__name__}, {ex}, sha: {sha}")
-        if len(filenames) == 0:
-            print(f'Processing {dirpath}')
-            print(f'Commits in the db: {database.commits.estimated_document_count()}')
+def list_shards(storage_path: Path) -> List[str]:
+    """
+    Commit files are stored as <sha[:2]>/<sha[2:4]>/<sha[4:]>, each second-level directory is a shard.
+    """
+    return sorted(f'{top.name}/{sub.name}' for top in storage_path.iterdir() if top.is_dir() for sub in top.iterdir() if sub.is_dir())
+
+
+def read_commit_file(path: Path) -> Optional[Dict]:
+    with path.open() as f:
+        try:
+            dct = json.loads(f.read())
+        except JSONDecodeError:
+            logger.warning(f"File {path} is corrupted. Skipping")
+            return None
+    dct = validate_and_fix_tool_ids(dct)
+    check_no_dots_and_dollars_in_keys(dct)
+    # no value can be larger than the file it is read from, so only values of large files need to be measured (and encoded)
+    if path.stat().st_size > ENCODE_THRESHOLD:
+        dct = {key: encode_value(value) for key, value in dct.items()}
+    return dct
 
 
-if __name__ == '__main__':
-    save_commits_from_fs_to_db(db)
+def get_existing_keys(database, shas: List[Sha]) -> Dict[Sha, Set[str]]:
+    """
+    Returns top-level keys of commit documents without transferring their values.
+    """
+    pipeline = [
+        {'$match': {'_id': {'$in': shas}}},
+        {'$project': {'keys': {'$map': {'input': {'$objectToArray': '$$ROOT'}, 'as': 'kv', 'in': '$$kv.k'}}}}
+    ]
+    return {doc['_id']: set(doc['keys']) for doc in database.commits.aggregate(pipeline)}
 
 
+def save_document(database, sha: Sha, values: Dict) -> bool:
+    """
+    Retry path for documents that failed in a bulk write: like `db.save_commit_result`, values are set one by one
+    and those that still do not fit are moved to the `chunks` collection. Returns False if the document could not be saved.
+    """
+    try:
+        database.commits.update_one({'_id': sha}, {'$set': values, '$currentDate': {UPDATED_AT: True}}, upsert=True)
+        return True
+    except (WriteError, DocumentTooLarge):
+        pass
+    try:
+        for key, value in values.items():
+            try:
+                database.commits.update_one({'_id': sha}, {'$set': {key: value}, '$currentDate': {UPDATED_AT: True}}, upsert=True)
+            except (WriteError, DocumentTooLarge):
+                database.commits.update_one({'_id': sha}, {'$set': {key: encode_value(value, database, threshold=0, max_inline_size=0)},
+                                                           '$currentDate': {UPDATED_AT: True}}, upsert=True)
+        return True
+    except (WriteError, DocumentTooLarge, BulkWriteError) as ex:
+        logger.error(f"Exception: {type(ex).__name__}, {ex}, sha: {sha}")
+        return False
+
+
+def save_batch(database, batch: List[Tuple[Sha, Dict]]) -> Tuple[int, int]:
+    """
+    Upserts commits setting only the keys that are not in the database yet.
+    Returns the number of written documents and the number of documents that could not be written.
+    """
+    existing_keys = get_existing_keys(database, [sha for sha, _ in batch])
+    documents = []
+    for sha, dct in batch:
+        missing = {key: value for key, value in dct.items() if key not in existing_keys.get(sha, set()) and key != '_id'}
+        if missing:
+            documents.append((sha, missing))
+    if not documents:
+        return 0, 0
+    operations = [UpdateOne({'_id': sha}, {'$set': missing, '$currentDate': {UPDATED_AT: True}}, upsert=True) for sha, missing in documents]
+    try:
+        database.commits.bulk_write(operations, ordered=False)
+        return len(documents), 0
+    except BulkWriteError as ex:
+        failed_indices = sorted({error['index'] for error in ex.details['writeErrors']})
+    except DocumentTooLarge:
+        # raised before sending the offending document, so it is not known which one it is
+        failed_indices = range(len(documents))
+    logger.warning(f'{len(failed_indices)}/{len(documents)} documents failed to be saved, retrying them one by one ...')
+    n_failed = sum(not save_document(database, *documents[i]) for i in failed_indices)
+    return len(documents) - n_failed, n_failed
+
+
+_database = None
+
+
+def init_worker() -> None:
+    global _database
+    _database = get_db()
+
+
+def migrate_shard(param: Tuple[Path, str, int]) -> Tuple[str, Dict[str, int]]:
+    storage_path, shard, batch_size = param
+    stats = {'files': 0, 'written': 0, 'failed': 0}
+    batch = []
+    for path in sorted((storage_path / shard).iterdir()):
+        sha = shard.replace('/', '') + path.name
+        if len(sha) != 40:
+            raise AssertionError(sha)
+        stats['files'] += 1
+        try:
+            dct = read_commit_file(path)
+        except (ValueError, OSError) as ex:
+            logger.error(f"Exception: {type(ex).__name__}, {ex}, sha: {sha}")
+            stats['failed'] += 1
+            continue
+        if dct is not None:
+            batch.append((sha, dct))
+        if len(batch) >= batch_size:
+            save_batch_and_count(batch, stats)
+            batch = []
+    if batch:
+        save_batch_and_count(batch, stats)
+    return shard, stats
+
+
+def save_batch_and_count(batch: List[Tuple[Sha, Dict]], stats: Dict[str, int]) -> None:
+    n_written, n_failed = save_batch(_database, batch)
+    stats['written'] += n_written
+    stats['failed'] += n_failed
+
+
+def save_commits_from_fs_to_db(storage_path: Path, n_processes: int = os.cpu_count(), batch_size: int = BATCH_SIZE,
+                               checkpoint_path: Path = CHECKPOINT_PATH) -> None:
+    """
+    Migrates commit files in parallel, shards are distributed among processes.
+    Completed shards are appended to the checkpoint file and skipped when the migration is restarted.
+    Shards with files that could not be migrated are not checkpointed, so they are retried.
+    """
+    done = set(checkpoint_path.read_text().split()) if checkpoint_path.exists() else set()
+    shards = [shard for shard in list_shards(storage_path) if shard not in done]
+    logger.info(f'{len(done)} shards already migrated, {len(shards)} to go.')
+    total = {'files': 0, 'written': 0, 'failed': 0}
+    with Pool(n_processes, initializer=init_worker) as pool, checkpoint_path.open('a') as checkpoint:
+        params = [(storage_path, shard, batch_size) for shard in shards]
+        for shard, stats in tqdm(pool.imap_unordered(migrate_shard, params), total=len(shards), desc='Shards: '):
+            for key, value in stats.items():
+                total[key] += value
+            if stats['failed'] == 0:
+                checkpoint.write(shard + '\n')
+                checkpoint.flush()
+    logger.info(f'Files read: {total["files"]}, documents written: {total["written"]}, failed: {total["failed"]}')
+
+
+if __name__ == '__main__':
+    save_commits_from_fs_to_db(Path(os.environ['COMMIT_EXPLORER_STORAGE']))
@@ -1,15 +1,34 @@
-# Requires the PyMongo package.
-# https://api.mongodb.com/python/current
-from pymongo import MongoClient
-from tqdm import tqdm
-
-client = MongoClient('mongodb://10.10.20.160:27017/?readPreference=primary&appname=MongoDB%20Compass&directConnection=true&ssl=false')
-result = client['commit_explorer']['commits'].find({'gumtree/3_0_0-beta2': {
-    '$exists': True
-}})
-
-for commit in tqdm(result):
-    if isinstance(commit["gumtree/3_0_0-beta2"], dict):
-        lst = [{"file": key, **value} for key, value in  commit["gumtree/3_0_0-beta2"].items()]
-        commit["gumtree/3_0_0-beta2"] = lst
-        client['commit_explorer']['commits'].replace_one({'_id': commit['_id']}, commit)
\ No newline at end of file
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.migrate.runner import Migration
+
+FIELD = 'gumtree/3_0_0-beta2'
+
+
+class GumtreeFilesObjectToArray(Migration):
+    # also matches arrays of objects, those are skipped in `migrate`
+    query = {FIELD: {'$type': 'object'}}
+    projection = {FIELD: 1}
+
+    @staticmethod
+    def files_object_to_array(files: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        >>> GumtreeFilesObjectToArray.files_object_to_array({'A.java': {'status': 'ok'}})
+        [{'file': 'A.java', 'status': 'ok'}]
+        """
+        return [{"file": key, **value} for key, value in files.items()]
+
+    def migrate(self, doc: Dict[str, Any]) -> Optional[UpdateOne]:
+        if not isinstance(doc[FIELD], dict):
+            return None
+        return UpdateOne({'_id': doc['_id']}, {'$set': {FIELD: self.files_object_to_array(doc[FIELD])},
+                                                 '$currentDate': {UPDATED_AT: True}})
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('gumtree_files_object_to_array')
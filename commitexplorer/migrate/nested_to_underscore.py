@@ -1,18 +1,33 @@
-# Requires the PyMongo package.
-# https://api.mongodb.com/python/current
-from pymongo import MongoClient
+from typing import Any, Dict
 
-client = MongoClient('mongodb://10.10.20.160:27017/?readPreference=primary&appname=MongoDB%20Compass&directConnection=true&ssl=false')
-result = client['commit_explorer']['commits'].update_many({'gumtree/3': {
-        '$exists': True
-    }}, [{
-        '$unset': 'gumtree/3_0_0-beta2'
-    }, {
-        '$set': {
-            'gumtree/3_0_0-beta2': '$$CURRENT.gumtree/3.0.0-beta2'
-        }
-    }, {
-        '$unset': 'gumtree/3'
-    }
-])
+from pymongo import UpdateOne
 
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.migrate.runner import Migration
+
+
+class NestedToUnderscore(Migration):
+    # 'gumtree/3.0.0-beta2' was saved as a nested document: {'gumtree/3': {'0': {'0-beta2': ...}}}
+    query = {'gumtree/3': {'$exists': True}}
+    projection = {'_id': 1}
+
+    def migrate(self, doc: Dict[str, Any]) -> UpdateOne:
+        return UpdateOne({'_id': doc['_id']}, [{
+            '$unset': 'gumtree/3_0_0-beta2'
+        }, {
+            '$set': {
+                'gumtree/3_0_0-beta2': '$$CURRENT.gumtree/3.0.0-beta2'
+            }
+        }, {
+            '$unset': 'gumtree/3'
+        }, {
+            '$set': {
+                UPDATED_AT: '$$NOW'
+            }
+        }])
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('nested_to_underscore')
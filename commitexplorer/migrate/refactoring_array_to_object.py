@@ -1,15 +1,23 @@
-# Requires the PyMongo package.
-# https://api.mongodb.com/python/current
-from pymongo import MongoClient
-from tqdm import tqdm
-
-client = MongoClient('mongodb://10.10.20.160:27017/?readPreference=primary&appname=MongoDB%20Compass&directConnection=true&ssl=false')
-result = client['commit_explorer']['commits'].find({'refactoring_miner/2_1_0': {
-    '$exists': True
-}})
-
-for commit in tqdm(result):
-    if isinstance(commit['refactoring_miner/2_1_0'], list):
-        obj = {'status': 'ok', 'refactorings': commit['refactoring_miner/2_1_0']}
-        commit['refactoring_miner/2_1_0'] = obj
-        client['commit_explorer']['commits'].replace_one({'_id': commit['_id']}, commit)
\ No newline at end of file
+from typing import Any, Dict
+
+from pymongo import UpdateOne
+
+from commitexplorer.db import UPDATED_AT
+from commitexplorer.migrate.runner import Migration
+
+FIELD = 'refactoring_miner/2_1_0'
+
+
+class RefactoringArrayToObject(Migration):
+    query = {FIELD: {'$type': 'array'}}
+    projection = {'_id': 1}
+
+    def migrate(self, doc: Dict[str, Any]) -> UpdateOne:
+        # the array is wrapped on the server, so it does not have to be transferred
+        return UpdateOne({'_id': doc['_id']}, [{'$set': {FIELD: {'status': 'ok', 'refactorings': f'${FIELD}'}, UPDATED_AT: '$$NOW'}}])
+
+
+if __name__ == '__main__':
+    from commitexplorer.cli import get_db
+    from commitexplorer.migrate.runner import MigrationRunner
+    MigrationRunner(get_db()).run('refactoring_array_to_object')
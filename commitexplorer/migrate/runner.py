@@ -0,0 +1,183 @@
+import importlib
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from pymongo import UpdateOne, ReplaceOne
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+MIGRATIONS_COLLECTION = 'migrations'
+HEX_DIGITS = '0123456789abcdef'
+# the single range of migrations whose collection is not keyed by commit shas
+ALL_IDS = 'all'
+
+# migration id -> "module:class", imported only when the migration is run
+migration_registry = {
+    'dot_to_underscore': 'commitexplorer.migrate.dot_to_underscore:DotToUnderscore',
+    'nested_to_underscore': 'commitexplorer.migrate.nested_to_underscore:NestedToUnderscore',
+    'gumtree_files_object_to_array': 'commitexplorer.migrate.gumtree_files_object_to_array:GumtreeFilesObjectToArray',
+    'refactoring_array_to_object': 'commitexplorer.migrate.refactoring_array_to_object:RefactoringArrayToObject',
+    'backfill_commits_updated_at': 'commitexplorer.migrate.backfill_updated_at:BackfillCommitsUpdatedAt',
+    'backfill_issues_updated_at': 'commitexplorer.migrate.backfill_updated_at:BackfillIssuesUpdatedAt',
+    'embedded_to_per_tool': 'commitexplorer.migrate.embedded_to_per_tool:EmbeddedToPerTool',
+}
+
+
+def get_migration_class(migration_id: str) -> Type['Migration']:
+    """
+    >>> get_migration_class('dot_to_underscore').__name__
+    'DotToUnderscore'
+    >>> get_migration_class('unknown')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown migration: unknown
+    """
+    if migration_id not in migration_registry:
+        raise ValueError(f'Unknown migration: {migration_id}')
+    module_name, class_name = migration_registry[migration_id].split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class Migration(ABC):
+    """
+    A migration selects documents with `query`, reads only `projection` of each of them
+    and returns a write operation (or None if the document does not need to be changed) for each document.
+    Write operations set `updated_at`, which versions documents for incremental exports and cached server responses.
+    Documents are processed in ranges of their sha `_id`s, unless `split_by_sha` is unset.
+    """
+    collection = 'commits'
+    split_by_sha = True
+    query: Dict[str, Any] = {}
+    projection: Optional[Dict[str, Any]] = None
+
+    @abstractmethod
+    def migrate(self, doc: Dict[str, Any]) -> Optional[Union[UpdateOne, ReplaceOne]]:
+        pass
+
+    def migrate_batch(self, database, docs: List[Dict[str, Any]]) -> int:
+        """
+        Writes the operations of a batch of documents with one unordered bulk write and returns their number.
+        Migrations that also write to other collections override it.
+        """
+        operations = [op for op in map(self.migrate, docs) if op is not None]
+        if operations:
+            database[self.collection].bulk_write(operations, ordered=False)
+        return len(operations)
+
+
+def get_id_ranges(n_ranges: int) -> List[Tuple[str, Optional[str]]]:
+    """
+    Splits the hex sha space into ranges of [start, end).
+
+    >>> get_id_ranges(4)
+    [('0', '4'), ('4', '8'), ('8', 'c'), ('c', None)]
+    >>> len(get_id_ranges(32)), get_id_ranges(32)[:2]
+    (32, [('00', '08'), ('08', '10')])
+    """
+    n_digits = 1
+    while 16 ** n_digits < n_ranges:
+        n_digits += 1
+    total = 16 ** n_digits
+    bounds = [format(i * total // n_ranges, f'0{n_digits}x') for i in range(n_ranges)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:] + [None])]
+
+
+class RateLimiter:
+    """
+    Limits the number of documents processed per second across all threads.
+    """
+    def __init__(self, max_per_second: Optional[float]):
+        self.max_per_second = max_per_second
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self, n: int) -> None:
+        if not self.max_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(self.next_time, now) + n / self.max_per_second
+        if wait > 0:
+            time.sleep(wait)
+
+
+class MigrationRunner:
+    """
+    Runs a migration in `_id`-ordered batches, each batch is written with one unordered bulk write.
+    The `_id` space is split into ranges that are processed in parallel. The last processed `_id` of each range
+    is stored in the `migrations` collection after each batch together with the number of ranges,
+    so an interrupted migration continues where it stopped, with the same ranges.
+    Once all ranges are done, the migration is marked as applied and is not run again unless forced.
+    """
+    def __init__(self, database, batch_size: int = 1000, max_docs_per_second: Optional[float] = None, n_workers: int = 4, n_ranges: int = 16):
+        self.database = database
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(max_docs_per_second)
+        self.n_workers = n_workers
+        self.n_ranges = n_ranges
+
+    def is_applied(self, migration_id: str) -> bool:
+        state = self.database[MIGRATIONS_COLLECTION].find_one({'_id': migration_id}, {'status': 1})
+        return state is not None and state.get('status') == 'applied'
+
+    def run(self, migration_id: str, force: bool = False) -> None:
+        migrations = self.database[MIGRATIONS_COLLECTION]
+        if force:
+            migrations.delete_one({'_id': migration_id})
+        elif self.is_applied(migration_id):
+            logger.info(f'Migration {migration_id} is already applied.')
+            return
+        migration = get_migration_class(migration_id)()
+        migrations.update_one({'_id': migration_id}, {'$setOnInsert': {'status': 'running', 'started_at': datetime.utcnow(),
+                                                                        'n_ranges': self.n_ranges, 'ranges': {}, 'n_migrated': 0}}, upsert=True)
+        state = migrations.find_one({'_id': migration_id})
+        # progress is stored per range, so a resumed migration has to use the ranges it was started with
+        n_ranges = state.get('n_ranges', self.n_ranges)
+        if n_ranges != self.n_ranges:
+            logger.info(f'Migration {migration_id} was started with {n_ranges} ranges, resuming it with them instead of {self.n_ranges}.')
+        all_ranges = get_id_ranges(n_ranges) if migration.split_by_sha else [(ALL_IDS, None)]
+        ranges = [(start, end) for start, end in all_ranges if state['ranges'].get(start) != 'done']
+        if len(ranges) < len(all_ranges):
+            logger.info(f'Resuming migration {migration_id}, {len(all_ranges) - len(ranges)}/{len(all_ranges)} ranges are already done.')
+        with tqdm(desc=migration_id, unit='docs') as pbar, ThreadPool(self.n_workers) as pool:
+            pool.map(lambda r: self._run_on_range(migration_id, migration, r[0], r[1], state['ranges'].get(r[0]), pbar), ranges)
+        migrations.update_one({'_id': migration_id}, {'$set': {'status': 'applied', 'applied_at': datetime.utcnow()}})
+        logger.info(f'Migration {migration_id} applied.')
+
+    def _run_on_range(self, migration_id: str, migration: Migration, start: str, end: Optional[str], last_id: Optional[str], pbar: tqdm) -> None:
+        collection = self.database[migration.collection]
+        while True:
+            id_condition = {}
+            if last_id is not None:
+                id_condition['$gt'] = last_id
+            elif start != ALL_IDS:
+                id_condition['$gte'] = start
+            if end is not None:
+                id_condition['$lt'] = end
+            if not id_condition:
+                id_condition['$exists'] = True
+            docs = list(collection.find({'$and': [migration.query, {'_id': id_condition}]}, migration.projection)
+                        .sort('_id', 1).limit(self.batch_size))
+            if not docs:
+                break
+            self.rate_limiter.acquire(len(docs))
+            n_migrated = migration.migrate_batch(self.database, docs)
+            last_id = docs[-1]['_id']
+            self.database[MIGRATIONS_COLLECTION].update_one({'_id': migration_id}, {
+                '$set': {f'ranges.{start}': last_id},
+                '$inc': {'n_migrated': n_migrated}
+            })
+            pbar.update(len(docs))
+        self.database[MIGRATIONS_COLLECTION].update_one({'_id': migration_id}, {'$set': {f'ranges.{start}': 'done'}})
+
+
+def get_migration_states(database) -> Dict[str, Dict[str, Any]]:
+    return {state['_id']: state for state in database[MIGRATIONS_COLLECTION].find({}, {'ranges': 0})}
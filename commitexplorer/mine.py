@@ -12,9 +12,9 @@ from tqdm import tqdm
 
 from commitexplorer import project_root
 from commitexplorer.common import Tool, clone_project, Sha, GithubProject, GitProject, ProjectObj
-from commitexplorer.db import save_results, mark_project_as_run, get_already_explored_commits, \
-    get_tools_not_run_on_project, get_important_commits
-from commitexplorer.tools import tool_id_map
+from commitexplorer.db import get_already_explored_commits, get_tools_not_run_on_project, iter_important_commits
+from commitexplorer.tools import get_tool_class
+from commitexplorer.writer import ResultWriter
 
 
 logger = logging.getLogger(__name__)
@@ -30,15 +30,12 @@ class Job:
 @dataclass
 class JobList:
     tools: List[str]
-    projects: Dict[Union[GithubProject, GitProject], Optional[Set[Sha]]]
+    projects: List[Tuple[Union[GithubProject, GitProject], Optional[Set[Sha]]]]
 
-    def __iter__(self) -> Job:
-        for project, limited_to_shas in sorted(self.projects.items(), key=lambda p: p[0].get_repo_id()):
+    def __iter__(self) -> Generator[Job, None, None]:
+        for project, limited_to_shas in self.projects:
             yield Job(self.tools, project, limited_to_shas)
 
-    def __len__(self):
-        return len(self.projects)
-
     @staticmethod
     def from_projects(project_names: List[str]) -> Dict[ProjectObj, Optional[Set[Sha]]]:
         projects = {}
@@ -60,24 +57,21 @@ class JobList:
 
         if 'projects' in config:
             projects = JobList.from_projects(config['projects'])
+            return cls(config['tools'], sorted(projects.items(), key=lambda p: p[0].get_repo_id()))
         elif 'commit-query' in config:
-            logger.info('Commit query is passed. Quering commits that need to be mined ...')
-            projects = get_important_commits(database, config['commit-query'])
-            n_commits = len([c for project_commits in projects.values() for c in project_commits])
-            logger.info(f'Running tools for {n_commits} commits ...')
+            logger.info('Commit query is passed. Looking up commits that need to be mined ...')
+            # read completely before mining starts, a cursor left idle while long projects are mined would time out
+            return cls(config['tools'], list(iter_important_commits(database, config['commit-query'])))
         else:
             raise ValueError(f'Invalid job.json. Neither projects no commit-query field was found.')
 
-        return cls(config['tools'], projects)
-
 
-def get_tool_by_id(id: str) -> Tool:
+def get_tool_by_id(id: str, database=None) -> Tool:
     id_parts = id.split('/')
     tool_id, version = id_parts if len(id_parts) == 2 else (id_parts[0], None)
-    if tool_id not in tool_id_map:
-        raise ValueError(f'Unknown tool: {tool_id}. Check job.json file')
-    tool_class = tool_id_map[tool_id]
+    tool_class = get_tool_class(tool_id)
     tool = tool_class(version)
+    tool.database = database
     return tool
 
 
@@ -89,7 +83,7 @@ def get_all_commits(repo: Repository) -> List[Commit]:
     return all_commits
 
 
-def run_tools_on_project(tools: List[Tuple[str, Tool]], project: GithubProject, repo: Repository, database, limited_to_shas: Optional[Set[Sha]] = None) -> Generator:
+def run_tools_on_project(tools: List[Tuple[str, Tool]], project: GithubProject, repo: Repository, database, writer: ResultWriter, limited_to_shas: Optional[Set[Sha]] = None) -> None:
     all_commits_from_newest = get_all_commits(repo)
     for tool_id, tool in tools:
         try:
@@ -105,22 +99,30 @@ def run_tools_on_project(tools: List[Tuple[str, Tool]], project: GithubProject,
                 if commit_to_start_from > 0:
                     logger.info(f'Tool has already run on some commits, starting running tool {tool_id} '
                           f'on commit number {commit_to_start_from} counting from the newest ({all_commits_from_newest[commit_to_start_from].hex})')
-                for result_batch in tool.run_on_project(project, all_commits_from_newest[commit_to_start_from:], limited_to_shas):
+                shas_to_run = limited_to_shas
+                if tool.batch_api:
+                    # batch tools run on arbitrary sets of commits, so commits already explored as part of another project
+                    # (e.g. a fork mined before) are skipped, not only the already explored history before the first new commit
+                    shas_to_run = {commit.hex for commit in all_commits_from_newest[commit_to_start_from:]
+                                   if commit.hex not in already_explored_commits}
+                    if limited_to_shas is not None:
+                        shas_to_run &= limited_to_shas
+                for result_batch in tool.run_on_project(project, all_commits_from_newest[commit_to_start_from:], shas_to_run):
                     commit_results: Dict[Sha, Dict[str, Any]] = {}
                     for sha, commit_result in result_batch.items():
                         if sha not in commit_result:
                             commit_results[sha] = {}
                         commit_results[sha][tool_id] = commit_result
-                    yield commit_results
+                    writer.save_results(commit_results, project)
             if limited_to_shas is None:
-                mark_project_as_run(project, tool_id, database)
+                writer.mark_project_as_run(project, tool_id)
         except Exception as ex:
             logger.exception(f"Exception: {type(ex).__name__}, {ex}, skipping tool: {tool_id}  (project: {project})")
             traceback.print_tb(ex.__traceback__)
 
 
 def run_job(param):
-    job, database = param
+    job, database, writer = param
     with open(project_root / 'github.token') as f:
         token = f.read().strip()
     try:
@@ -128,9 +130,10 @@ def run_job(param):
         if repo is not None:
             tool_ids__to_run = get_tools_not_run_on_project(job.tools, job.project, database)
             if tool_ids__to_run:
-                tools_to_run = [(tool_id, get_tool_by_id(tool_id)) for tool_id in job.tools]
-                for result_batch in run_tools_on_project(tools_to_run, job.project, repo, database, job.limited_to_shas):
-                    save_results(result_batch, job.project, database)
+                if job.limited_to_shas is not None:
+                    logger.info(f'Running tools for {len(job.limited_to_shas)} commits of {job.project} ...')
+                tools_to_run = [(tool_id, get_tool_by_id(tool_id, database)) for tool_id in job.tools]
+                run_tools_on_project(tools_to_run, job.project, repo, database, writer, job.limited_to_shas)
             else:
                 logger.info(f'Skipping {job.project}. Tools has been already run')
             return job.project
@@ -145,8 +148,8 @@ def mine(database):
 
     n_processes = os.cpu_count() // 2
     logger.info(f"Using {n_processes} processes")
-    with ThreadPool(processes=n_processes) as pool:
-        job_parameters = [(job, database) for job in job_list]
+    with ResultWriter(database) as writer, ThreadPool(processes=n_processes) as pool:
+        job_parameters = [(job, database, writer) for job in job_list]
         it = pool.imap_unordered(run_job, job_parameters, chunksize=1)
         for _ in tqdm(it, total=len(job_parameters), desc="Jobs: "):
             pass
\ No newline at end of file
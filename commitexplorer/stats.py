@@ -0,0 +1,257 @@
+import logging
+from collections import Counter
+from typing import Any, Dict, Generator, Iterable, List, Optional
+
+from commitexplorer.codec import CODEC_KEY, decode_value
+from commitexplorer.db import STATS_COLLECTION, STORAGE_LAYOUT, STORAGE_LAYOUT_PER_TOOL, tool_collection_name, \
+    tool_field_from_collection_name, get_tool_collection_names
+from commitexplorer.indexes import LABEL_FIELDS
+from commitexplorer.tools import tool_registry
+
+logger = logging.getLogger(__name__)
+
+
+# project ids are `owner/repo` or git urls, so they never clash with this one
+GLOBAL_STATS_ID = '__all__'
+CONVENTIONAL_COMMIT_FIELD = 'conventional_commit'
+REFACTORING_MINER_FIELD = 'refactoring_miner/2_1_0'
+# number of shas per `$in` query when tool results are stored in their own collections
+STATS_SHA_BATCH_SIZE = 10000
+
+
+def get_project_query(project_id: str) -> Dict[str, Any]:
+    """
+    >>> get_project_query('giganticode/bohr')
+    {'owner': 'giganticode', 'repo': 'bohr'}
+    >>> get_project_query('https://gitlab.com/a/b.git')
+    {'url': 'https://gitlab.com/a/b.git'}
+    """
+    if '://' in project_id or project_id.startswith('git@'):
+        return {'url': project_id}
+    owner, repo = project_id.split('/', 1)
+    return {'owner': owner, 'repo': repo}
+
+
+def iter_project_ids(database) -> Generator[str, None, None]:
+    for doc in database.commits.aggregate([{'$match': {'owner': {'$exists': True}}},
+                                           {'$group': {'_id': {'owner': '$owner', 'repo': '$repo'}}}], allowDiskUse=True):
+        yield f'{doc["_id"]["owner"]}/{doc["_id"]["repo"]}'
+    yield from database.commits.distinct('url', {'url': {'$exists': True}})
+
+
+def is_tool_field(field: str) -> bool:
+    """
+    Results are stored in fields named after the tool id in `tool_registry`, followed by the version if the tool has one.
+
+    >>> is_tool_field('refactoring_miner/2_1_0'), is_tool_field('message'), is_tool_field('mine_sstubs_chunked/head'), is_tool_field('manual_labels')
+    (True, True, True, False)
+    """
+    return field.split('/', 1)[0] in tool_registry
+
+
+def get_tool_result_fields(database, query: Dict[str, Any]) -> List[str]:
+    """
+    Tool result fields present in the documents of the `commits` collection matching `query`,
+    including versions of tools that are not known in advance.
+    """
+    pipeline = [{'$match': query},
+                {'$project': {'_id': 0, 'fields': {'$map': {'input': {'$objectToArray': '$$ROOT'}, 'in': '$$this.k'}}}},
+                {'$unwind': '$fields'},
+                {'$group': {'_id': '$fields'}}]
+    return sorted(doc['_id'] for doc in database.commits.aggregate(pipeline, allowDiskUse=True) if is_tool_field(doc['_id']))
+
+
+def to_histogram(counter: Counter) -> List[Dict[str, Any]]:
+    """
+    Values are stored in lists rather than as keys of a document, because they may contain dots.
+
+    >>> to_histogram(Counter({'ok': 3, None: 1, 'timeout': 3}))
+    [{'value': 'ok', 'count': 3}, {'value': 'timeout', 'count': 3}, {'value': None, 'count': 1}]
+    """
+    return [{'value': value, 'count': count} for value, count in sorted(counter.items(), key=lambda e: (-e[1], str(e[0])))]
+
+
+def from_histogram(histogram: Iterable[Dict[str, Any]]) -> Counter:
+    return Counter({entry['value']: entry['count'] for entry in histogram})
+
+
+def aggregate_counts(collection, query: Dict[str, Any], key: Any, unwind: Optional[str] = None) -> Counter:
+    pipeline = [{'$match': query}]
+    if unwind is not None:
+        pipeline.append({'$unwind': f'${unwind}'})
+    pipeline.append({'$group': {'_id': key, 'count': {'$sum': 1}}})
+    return Counter({doc['_id']: doc['count'] for doc in collection.aggregate(pipeline, allowDiskUse=True)})
+
+
+def count_value(field: str, value: Any, stats: Dict[str, Counter]) -> None:
+    """
+    Adds a single (decoded) tool result to the stats, the same way `get_result_stats` counts them in the database.
+
+    >>> stats = {'statuses': Counter(), 'refactoring_types': Counter()}
+    >>> count_value('refactoring_miner/2_1_0', {'status': 'ok', 'refactorings': [{'type': 'Rename Method'}]}, stats)
+    >>> stats
+    {'statuses': Counter({'ok': 1}), 'refactoring_types': Counter({'Rename Method': 1})}
+    """
+    is_dict = isinstance(value, dict)
+    stats['statuses'][value.get('status') if is_dict else None] += 1
+    if field == CONVENTIONAL_COMMIT_FIELD:
+        stats['conventional_types'][value.get('type') if is_dict else None] += 1
+    if field == REFACTORING_MINER_FIELD and is_dict and isinstance(value.get('refactorings'), list):
+        stats['refactoring_types'].update(refactoring.get('type') for refactoring in value['refactorings'])
+
+
+def get_result_stats(collection, query: Dict[str, Any], path: str, field: str) -> Dict[str, Counter]:
+    """
+    Counts results of the tool `field` stored at `path` in the documents of `collection` matching `query`.
+    Results too large to be stored inline are decoded and counted here, all others are counted by MongoDB.
+    """
+    stats = {'statuses': Counter()}
+    if field == CONVENTIONAL_COMMIT_FIELD:
+        stats['conventional_types'] = Counter()
+    if field == REFACTORING_MINER_FIELD:
+        stats['refactoring_types'] = Counter()
+
+    inline_query = {**query, path: {'$exists': True}, f'{path}.{CODEC_KEY}': {'$exists': False}}
+    # for lists (e.g. files) `$<path>.status` would be the list of statuses of all elements
+    status = {'$cond': [{'$isArray': f'${path}'}, None, f'${path}.status']}
+    stats['statuses'] += aggregate_counts(collection, inline_query, status)
+    if field == CONVENTIONAL_COMMIT_FIELD:
+        stats['conventional_types'] += aggregate_counts(collection, inline_query, f'${path}.type')
+    if field == REFACTORING_MINER_FIELD:
+        stats['refactoring_types'] += aggregate_counts(collection, {**inline_query, f'{path}.refactorings': {'$type': 'array'}},
+                                                       f'${path}.refactorings.type', unwind=f'{path}.refactorings')
+
+    for doc in collection.find({**query, f'{path}.{CODEC_KEY}': {'$exists': True}}, {path: 1}):
+        value = doc
+        for key in path.split('.'):
+            value = value[key]
+        count_value(field, decode_value(value, collection.database), stats)
+    return stats
+
+
+def add_result_stats(project_stats: Dict[str, Any], field: str, result_stats: Dict[str, Counter]) -> None:
+    if not result_stats['statuses']:
+        return
+    tool_stats = project_stats['tools'].setdefault(field, {'count': 0, 'statuses': Counter()})
+    tool_stats['count'] += sum(result_stats['statuses'].values())
+    tool_stats['statuses'] += result_stats['statuses']
+    project_stats['conventional_types'] += result_stats.get('conventional_types', Counter())
+    project_stats['refactoring_types'] += result_stats.get('refactoring_types', Counter())
+
+
+def compute_project_stats(database, project_id: str, layout: str = STORAGE_LAYOUT) -> Dict[str, Any]:
+    project_query = get_project_query(project_id)
+    project_stats = {
+        'n_commits': database.commits.count_documents(project_query),
+        'tools': {},
+        'conventional_types': Counter(),
+        'refactoring_types': Counter(),
+        'labels': Counter(),
+    }
+    if layout == STORAGE_LAYOUT_PER_TOOL:
+        # tool collections do not know which project a commit belongs to, so they are queried with the project's shas
+        tool_fields = [tool_field_from_collection_name(name) for name in get_tool_collection_names(database)]
+        shas = [doc['_id'] for doc in database.commits.find(project_query, {'_id': 1})]
+        for i in range(0, len(shas), STATS_SHA_BATCH_SIZE):
+            query = {'_id': {'$in': shas[i:i + STATS_SHA_BATCH_SIZE]}}
+            for field in tool_fields:
+                add_result_stats(project_stats, field, get_result_stats(database[tool_collection_name(field)], query, 'result', field))
+    else:
+        for field in get_tool_result_fields(database, project_query):
+            add_result_stats(project_stats, field, get_result_stats(database.commits, project_query, field, field))
+
+    for field in LABEL_FIELDS:
+        n_labeled = database.commits.count_documents({**project_query, field: {'$exists': True}})
+        if n_labeled:
+            project_stats['labels'][field] = n_labeled
+    return project_stats
+
+
+def to_stats_document(stats: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'n_commits': stats['n_commits'],
+        'tools': [{'field': field, 'count': tool_stats['count'], 'statuses': to_histogram(tool_stats['statuses'])}
+                  for field, tool_stats in sorted(stats['tools'].items())],
+        'conventional_types': to_histogram(stats['conventional_types']),
+        'refactoring_types': to_histogram(stats['refactoring_types']),
+        'labels': [{'field': field, 'count': count} for field, count in sorted(stats['labels'].items())],
+    }
+
+
+def merge_stats_documents(docs: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    >>> doc = {'n_commits': 2, 'tools': [{'field': 'message', 'count': 2, 'statuses': [{'value': None, 'count': 2}]}],
+    ...        'conventional_types': [], 'refactoring_types': [{'value': 'Rename Method', 'count': 3}],
+    ...        'labels': [{'field': 'manual_labels.herzig', 'count': 1}]}
+    >>> merged = merge_stats_documents([doc, doc, {'dirty': True}])
+    >>> merged['n_projects'], merged['n_commits'], merged['tools'], merged['refactoring_types'], merged['labels']
+    (2, 4, [{'field': 'message', 'count': 4, 'statuses': [{'value': None, 'count': 4}]}], [{'value': 'Rename Method', 'count': 6}], [{'field': 'manual_labels.herzig', 'count': 2}])
+    """
+    stats = {'n_commits': 0, 'tools': {}, 'conventional_types': Counter(), 'refactoring_types': Counter(), 'labels': Counter()}
+    n_projects = 0
+    for doc in docs:
+        if 'n_commits' not in doc:
+            # marked as dirty, but not computed yet
+            continue
+        n_projects += 1
+        stats['n_commits'] += doc['n_commits']
+        for tool in doc['tools']:
+            tool_stats = stats['tools'].setdefault(tool['field'], {'count': 0, 'statuses': Counter()})
+            tool_stats['count'] += tool['count']
+            tool_stats['statuses'] += from_histogram(tool['statuses'])
+        stats['conventional_types'] += from_histogram(doc['conventional_types'])
+        stats['refactoring_types'] += from_histogram(doc['refactoring_types'])
+        stats['labels'] += Counter({label['field']: label['count'] for label in doc['labels']})
+    return {'n_projects': n_projects, **to_stats_document(stats)}
+
+
+def refresh_project_stats(database, project_id: str, layout: str = STORAGE_LAYOUT) -> None:
+    stats_collection = database[STATS_COLLECTION]
+    dirty_version = (stats_collection.find_one({'_id': project_id}, {'dirty_version': 1}) or {}).get('dirty_version')
+    project_stats = compute_project_stats(database, project_id, layout)
+    stats_collection.update_one({'_id': project_id}, {'$set': to_stats_document(project_stats),
+                                                      '$currentDate': {'computed_at': True}}, upsert=True)
+    # if results were saved in the meantime, the version has changed and the project stays dirty for the next refresh
+    stats_collection.update_one({'_id': project_id, 'dirty_version': dirty_version}, {'$set': {'dirty': False}})
+
+
+def refresh_global_stats(database) -> None:
+    stats_collection = database[STATS_COLLECTION]
+    global_stats = merge_stats_documents(stats_collection.find({'_id': {'$ne': GLOBAL_STATS_ID}}))
+    stats_collection.replace_one({'_id': GLOBAL_STATS_ID}, {'_id': GLOBAL_STATS_ID, **global_stats}, upsert=True)
+    stats_collection.update_one({'_id': GLOBAL_STATS_ID}, {'$currentDate': {'computed_at': True}})
+
+
+def refresh_stats(database, full: bool = False, layout: str = STORAGE_LAYOUT) -> int:
+    """
+    Recomputes the stats of projects marked as dirty by `save_results` (or of all projects in the database if `full` is set),
+    and then the global stats from the per-project ones. Returns the number of recomputed projects.
+    """
+    stats_collection = database[STATS_COLLECTION]
+    if full:
+        project_ids = list(iter_project_ids(database))
+    else:
+        project_ids = [doc['_id'] for doc in stats_collection.find({'dirty': True}, {'_id': 1})]
+    for i, project_id in enumerate(project_ids):
+        logger.info(f'Computing stats for {project_id} ({i + 1}/{len(project_ids)}) ...')
+        refresh_project_stats(database, project_id, layout)
+    if project_ids or stats_collection.find_one({'_id': GLOBAL_STATS_ID}, {'_id': 1}) is None:
+        refresh_global_stats(database)
+    return len(project_ids)
+
+
+def get_stats(database, project_id: Optional[str] = None, max_time_ms: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Returns the precomputed stats of the project or, if no project is given, of the whole database.
+    """
+    return database[STATS_COLLECTION].find_one({'_id': project_id or GLOBAL_STATS_ID}, {'dirty_version': 0}, max_time_ms=max_time_ms)
+
+
+def get_tool_stats(database, field: str, max_time_ms: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    global_stats = get_stats(database, max_time_ms=max_time_ms)
+    if global_stats is None:
+        return None
+    tool_stats = next((tool for tool in global_stats['tools'] if tool['field'] == field), None)
+    if tool_stats is None:
+        return None
+    return {**tool_stats, 'computed_at': global_stats.get('computed_at')}
@@ -1,19 +1,31 @@
-from commitexplorer.tools.ccfinder import ConventionalCommitFinder
-from commitexplorer.tools.fileminer import FileMiner
-from commitexplorer.tools.messageminer import MessageMiner
-from commitexplorer.tools.gumtree import GumTree
-from commitexplorer.tools.refactoring_miner import RefactoringMiner
-from commitexplorer.tools.spacyrunner import SpacyRunner
-from commitexplorer.tools.special_commit_finder import SpecialCommitFinder
-from commitexplorer.tools.sstubs import SStubs
+import importlib
+from typing import Type
 
-tool_id_map = {
-    'refactoring_miner': RefactoringMiner,
-    'mine_sstubs': SStubs,
-    'special_commit_finder': SpecialCommitFinder,
-    'gumtree': GumTree,
-    'spacy': SpacyRunner,
-    'files': FileMiner,
-    'conventional_commit': ConventionalCommitFinder,
-    'message': MessageMiner,
-}
\ No newline at end of file
+# tool id -> "module:class", a tool module is imported only when a job uses the tool
+tool_registry = {
+    'refactoring_miner': 'commitexplorer.tools.refactoring_miner:RefactoringMiner',
+    'mine_sstubs': 'commitexplorer.tools.sstubs:SStubs',
+    'mine_sstubs_chunked': 'commitexplorer.tools.sstubs:ChunkedSStubs',
+    'special_commit_finder': 'commitexplorer.tools.special_commit_finder:SpecialCommitFinder',
+    'gumtree': 'commitexplorer.tools.gumtree:GumTree',
+    'spacy': 'commitexplorer.tools.spacyrunner:SpacyRunner',
+    'files': 'commitexplorer.tools.fileminer:FileMiner',
+    'conventional_commit': 'commitexplorer.tools.ccfinder:ConventionalCommitFinder',
+    'message': 'commitexplorer.tools.messageminer:MessageMiner',
+    'message_cleaner': 'commitexplorer.tools.messagecleaner:CommitMessageCleaner',
+}
+
+
+def get_tool_class(tool_id: str) -> Type:
+    """
+    >>> get_tool_class('message').__name__
+    'MessageMiner'
+    >>> get_tool_class('unknown')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown tool: unknown. Check job.json file
+    """
+    if tool_id not in tool_registry:
+        raise ValueError(f'Unknown tool: {tool_id}. Check job.json file')
+    module_name, class_name = tool_registry[tool_id].split(':')
+    return getattr(importlib.import_module(module_name), class_name)
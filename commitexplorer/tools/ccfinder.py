@@ -3,7 +3,7 @@ from dataclasses import dataclass
 
 import pygit2
 
-from commitexplorer.common import Tool
+from commitexplorer.common import Tool, CommitBatch
 
 cc_regex = re.compile('(?P<type>fix|feat|build|chore|ci|docs|style|refactor|perf|test)(?P<scope>(?:\([^()\r\n]*\)|\()?(?P<breaking>!)?)(?P<subject>:.*)?', re.DOTALL | re.IGNORECASE)
 
@@ -11,11 +11,26 @@ cc_regex = re.compile('(?P<type>fix|feat|build|chore|ci|docs|style|refactor|perf
 @dataclass
 class ConventionalCommitFinder(Tool):
     lightweight_commits = True
+    batch_api = True
 
-    def run_on_commit(self, commit: pygit2.Commit):
-        matcher = re.fullmatch(cc_regex, commit.message)
+    @staticmethod
+    def find_in_message(message: str):
+        """
+        >>> ConventionalCommitFinder.find_in_message('fix(parser): handle empty input')
+        {'type': 'fix', 'conventional': True}
+        >>> ConventionalCommitFinder.find_in_message('Handle empty input')
+        {'conventional': False}
+        """
+        matcher = cc_regex.fullmatch(message)
         if matcher is not None:
             return {'type': matcher.group('type'), 'conventional': True}
         else:
             return {'conventional': False}
 
+    def run_on_commit(self, commit: pygit2.Commit):
+        return self.find_in_message(commit.message)
+
+    def run_on_batch(self, batch: CommitBatch):
+        find_in_message = self.find_in_message
+        return {sha: find_in_message(message) for sha, message in zip(batch.shas, batch.messages)}
+
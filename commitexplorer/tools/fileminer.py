@@ -3,11 +3,15 @@ from typing import Any
 import pydriller
 from pydriller import ModificationType
 
+from commitexplorer.blobstore import BlobStore
 from commitexplorer.common import Tool
-from commitexplorer.util.accuratechanges import calculate_changes
+from commitexplorer.util.accuratechanges import fast_calculate_changes
 
 
 class FileMiner(Tool):
+    # pairs of longer lines (e.g. minified code) are reported as a whole replacement instead of diffing them
+    max_line_length = 10000
+
     @staticmethod
     def _get_status(self, file) -> str:
         if file.old_path is None and file.new_path is None:
@@ -21,8 +25,9 @@ class FileMiner(Tool):
     def run_on_commit(self, commit: pydriller.Commit) -> Any:
         res = []
         for file in commit.modified_files:
-            file_data = {'patch': file.diff,
-                         'changes': calculate_changes(file.diff),
+            patch = file.diff
+            file_data = {'patch': patch,
+                         'changes': fast_calculate_changes(patch, self.max_line_length),
                          'filename': file.new_path if file.new_path else file.old_path}
             if file.change_type == ModificationType.RENAME:
                 file_data['previous_filename'] = file.old_path
@@ -37,4 +42,11 @@ class FileMiner(Tool):
             else:
                 file_data['status'] = None
             res.append(file_data)
+        if self.database is not None:
+            # patches and changes are kept in the blob store, so that patches of forks are stored once
+            # and large commits do not exceed the document size limit; the commit document only references them
+            text_fields = [(file_data, key) for file_data in res for key in ['patch', 'changes'] if isinstance(file_data[key], str)]
+            values = BlobStore(self.database).put_many([file_data[key] for file_data, key in text_fields])
+            for (file_data, key), value in zip(text_fields, values):
+                file_data[key] = value
         return res
@@ -0,0 +1,102 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.util.List;
+
+import org.eclipse.jgit.lib.Repository;
+import org.refactoringminer.api.GitHistoryRefactoringMiner;
+import org.refactoringminer.api.GitService;
+import org.refactoringminer.api.Refactoring;
+import org.refactoringminer.api.RefactoringHandler;
+import org.refactoringminer.rm1.GitHistoryRefactoringMinerImpl;
+import org.refactoringminer.util.GitServiceImpl;
+
+/**
+ * Long-lived RefactoringMiner process for a single repository.
+ *
+ * Reads one request per line from stdin:
+ *   range <older-sha> <newer-sha>
+ *   commit <sha> <timeout-seconds>
+ * and writes one JSON object per analyzed commit to stdout, followed by {"done": true}.
+ *
+ * Launched by commitexplorer.tools.refactoring_miner.RefactoringMinerWorker with
+ * `java -cp <RefactoringMiner>/lib/* RefactoringMinerWorker.java <repo>` (Java 11+).
+ */
+public class RefactoringMinerWorker {
+
+    private static String quote(String s) {
+        StringBuilder sb = new StringBuilder("\"");
+        for (char c : s.toCharArray()) {
+            switch (c) {
+                case '"': sb.append("\\\""); break;
+                case '\\': sb.append("\\\\"); break;
+                case '\n': sb.append("\\n"); break;
+                case '\r': sb.append("\\r"); break;
+                case '\t': sb.append("\\t"); break;
+                default:
+                    if (c < 0x20) {
+                        sb.append(String.format("\\u%04x", (int) c));
+                    } else {
+                        sb.append(c);
+                    }
+            }
+        }
+        return sb.append('"').toString();
+    }
+
+    public static void main(String[] args) throws Exception {
+        // stdout is reserved for the protocol, everything the library logs goes to stderr
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, StandardCharsets.UTF_8.name());
+        System.setOut(System.err);
+
+        GitService gitService = new GitServiceImpl();
+        Repository repo = gitService.openRepository(args[0]);
+        GitHistoryRefactoringMiner miner = new GitHistoryRefactoringMinerImpl();
+
+        RefactoringHandler handler = new RefactoringHandler() {
+            @Override
+            public void handle(String commitId, List<Refactoring> refactorings) {
+                StringBuilder sb = new StringBuilder();
+                sb.append("{\"sha1\": ").append(quote(commitId)).append(", \"refactorings\": [");
+                for (int i = 0; i < refactorings.size(); i++) {
+                    if (i > 0) {
+                        sb.append(", ");
+                    }
+                    // toJSON() pretty-prints; newlines inside string values are escaped, so this is safe
+                    sb.append(refactorings.get(i).toJSON().replaceAll("[\r\n\t]+", ""));
+                }
+                sb.append("]}");
+                out.println(sb);
+            }
+
+            @Override
+            public void handleException(String commitId, Exception e) {
+                out.println("{\"sha1\": " + quote(commitId) + ", \"error\": " + quote(String.valueOf(e)) + "}");
+            }
+        };
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] parts = line.trim().split("\\s+");
+            try {
+                if (parts[0].equals("range")) {
+                    miner.detectBetweenCommits(repo, parts[1], parts[2], handler);
+                } else if (parts[0].equals("commit")) {
+                    miner.detectAtCommit(repo, parts[1], handler, Integer.parseInt(parts[2]));
+                } else if (parts[0].equals("quit")) {
+                    break;
+                } else {
+                    out.println("{\"error\": " + quote("Unknown request: " + line) + "}");
+                }
+            } catch (Exception e) {
+                out.println("{\"error\": " + quote(String.valueOf(e)) + "}");
+            }
+            out.println("{\"done\": true}");
+        }
+        repo.close();
+    }
+}
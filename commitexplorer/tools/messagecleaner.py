@@ -1,26 +1,42 @@
 import re
 from collections import Counter
-from dataclasses import field, dataclass
-from typing import List, Optional, Dict
+from dataclasses import field, dataclass, asdict
+from functools import lru_cache
+from typing import List, Optional, Dict, Iterable
 
 import nltk
 import pydriller
 
-from commitexplorer.common import Tool
+from commitexplorer import project_root
+from commitexplorer.common import Tool, CommitBatch
 
 from typing import Any, Set
 
-import pandas as pd
 from nltk import RegexpTokenizer
 
 
-from nltk.corpus import stopwords
-nltk.download('stopwords')
-stop_words = set(stopwords.words('english'))
+NLTK_DATA_CACHE = project_root / 'nltk-data'
+
+
+@lru_cache(maxsize=None)
+def get_stop_words() -> Set[str]:
+   """
+   Loads nltk stopwords on first use, downloading them to the local cache only if they are not found.
+   """
+   from nltk.corpus import stopwords
+   if str(NLTK_DATA_CACHE) not in nltk.data.path:
+      nltk.data.path.append(str(NLTK_DATA_CACHE))
+   try:
+      return set(stopwords.words('english'))
+   except LookupError:
+      nltk.download('stopwords', download_dir=str(NLTK_DATA_CACHE), quiet=True)
+      return set(stopwords.words('english'))
 
 
 ISSUE_REGEX = '(([A-Z]+\-)?[0-9]+)'
 URL_REGEX = "((http|ftp|https):\/\/([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:\/~+#-]*[\w@?^=%&\/~+#-]))( )?"
+URL_PATTERN = re.compile(URL_REGEX)
+WHITESPACE_PATTERN = re.compile('\s+')
 
 IDENTIFIER_REGEX = "[_a-zA-Z][_a-zA-Z0-9]*"
 COMPOUND_IDENTIFIER_REGEX = f"{IDENTIFIER_REGEX}[_A-Z][a-z]+[_a-zA-Z0-9]*"
@@ -43,12 +59,10 @@ TEST_CLASS_HIGH_PROB=re.compile(f'(?<!\w){CLASS_NAME}Test(?!\w)')
 # TODO file pattern !
 # TODO version pattern!   orif semver regex: ^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?$
 
-from nltk import PorterStemmer
-
 def safe_tokenize(text: Any) -> Set[str]:
    if text is None:
       return set()
-   if pd.isna(text):
+   if text != text:  # NaN
       return set()
 
    tokens = _tokenizer.tokenize(str(text).lower())
@@ -78,15 +92,22 @@ def extract_url(s: str) -> (str, Optional[str]):
    ('implement feature #1 (wip)', ['https://svn.apache.org/repos/asf/lucene/java/trunk@888780'])
    >>> extract_url('https://github.com and https://github.org')
    ('and ', ['https://github.org', 'https://github.com'])
+   >>> extract_url('no urls')
+   ('no urls', [])
    """
-   reg = re.compile(URL_REGEX)
-   matcher = reg.search(s)
+   pieces = []
    urls = []
-   if matcher:
-      st, urls = extract_url(s[matcher.end():])
+   pos = 0
+   for matcher in URL_PATTERN.finditer(s):
+      pieces.append(s[pos:matcher.start()])
       urls.append(matcher.group(1))
-      s = s[:matcher.start()] + st
-   return s, urls
+      pos = matcher.end()
+   if not urls:
+      return s, urls
+   pieces.append(s[pos:])
+   # urls are reported from the last to the first one
+   urls.reverse()
+   return ''.join(pieces), urls
 
 
 BUGTRACKER1 = 'https://issues.apache.org/bugzilla'
@@ -154,7 +175,7 @@ def clean_up_garbage(s: str) -> str:
    for regexes in PROJECT_SPECIFIC_CLEANUP_REGEXES.values():
       for regex in regexes:
          s = regex.sub('', s)
-   s = re.compile('\s+').sub(' ', s)
+   s = WHITESPACE_PATTERN.sub(' ', s)
    return s
 
 t = "- Added Unicode range to fix tokenization of Korean - http://issues.apache.org/jira/browse/LUCENE-444\n\ngit-svn-id: https://svn.apache.org/repos/asf/lucene/java/trunk@294982 13f79535-47bb-0310-9956-ffa450edef68"
@@ -193,8 +214,11 @@ def replace_identifiers(s: str) -> str:
    >>> replace_identifiers('enable FieldCache.Parser')
    'enable CLASS'
    """
-   s = TEST_CLASS_HIGH_PROB.sub('TESTCLASS', s)
-   s = EXCEPTION_HIGH_PROB.sub('EXCEPTION', s)
+   # cheap substring checks let most messages skip the scans that cannot match
+   if 'Test' in s:
+      s = TEST_CLASS_HIGH_PROB.sub('TESTCLASS', s)
+   if 'Error' in s or 'Exception' in s:
+      s = EXCEPTION_HIGH_PROB.sub('EXCEPTION', s)
    s = METHOD_NAME_HIGH_PROB.sub('METHOD', s)
    s = CLASS_HIGH_PROB.sub('CLASS', s)
    return s
@@ -225,11 +249,33 @@ def clean_message(s: str) -> CleanedCommitMessage:
    s, url = extract_url(s)
    s = replace_identifiers(s)
 
+   stop_words = get_stop_words()
    bag_of_words = Counter({t for t in safe_tokenize(s) if t not in stop_words})
    return CleanedCommitMessage(clean_message=s, bag_of_words=dict(bag_of_words), issue=issue, url=url)
 
 
+def clean_messages(messages: Iterable[str]) -> List[CleanedCommitMessage]:
+   """
+   Cleans many messages at once, every distinct message of the call is cleaned only once.
+   Commits shared with projects mined before (e.g. forks) do not get here, `mine` skips them for batch tools.
+
+   >>> m1, m2, m3 = clean_messages(['fix bug', 'Update README', 'fix bug'])
+   >>> m1 is m3, m2.clean_message
+   (True, 'Update README')
+   """
+   messages = list(messages)
+   cleaned_by_message = {message: clean_message(message) for message in dict.fromkeys(messages)}
+   return [cleaned_by_message[message] for message in messages]
+
+
 class CommitMessageCleaner(Tool):
+   lightweight_commits = True
+   batch_api = True
+
    def run_on_commit(self, commit: pydriller.Commit):
-      cleaned_commit = clean_message(commit.msg)
-      return cleaned_commit
+      cleaned_commit = clean_message(commit.message)
+      return asdict(cleaned_commit)
+
+   def run_on_batch(self, batch: CommitBatch):
+      cleaned_commits = clean_messages(batch.messages)
+      return {sha: asdict(cleaned_commit) for sha, cleaned_commit in zip(batch.shas, cleaned_commits)}
@@ -2,11 +2,15 @@ from typing import Any
 
 import pygit2
 
-from commitexplorer.common import Tool
+from commitexplorer.common import Tool, CommitBatch
 
 
 class MessageMiner(Tool):
     lightweight_commits = True
+    batch_api = True
 
     def run_on_commit(self, commit: pygit2.Commit) -> Any:
         return commit.message
+
+    def run_on_batch(self, batch: CommitBatch) -> Any:
+        return dict(zip(batch.shas, batch.messages))
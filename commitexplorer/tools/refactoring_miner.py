@@ -1,20 +1,32 @@
+import json
 import logging
+import queue
 import subprocess
 import tempfile
-from dataclasses import dataclass, field
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from typing import List, Dict, Tuple, Generator, Any, Optional, Set
 
-import jsons as jsons
 import pygit2
-from jsons import DecodeError
 from pygit2 import Commit, Repository
 
+from commitexplorer import commit_explorer_root
 from commitexplorer.common import Tool, clone_project, Sha, path_to_working_dir, ProjectObj
+from commitexplorer.util.jsonstream import iter_array
 
 
 logger = logging.getLogger(__name__)
 
+# a worker that dies this many times in a row without answering is assumed not to be able to start at all
+MAX_WORKER_FAILURES = 3
+
+
+class RefactoringMinerWorkerError(Exception):
+    pass
+
 
 @dataclass
 class RefactoringMinerCommit:
@@ -23,13 +35,137 @@ class RefactoringMinerCommit:
     url: str
     refactorings: List
 
+    @classmethod
+    def from_dict(cls, dct: Dict[str, Any]) -> 'RefactoringMinerCommit':
+        """
+        >>> RefactoringMinerCommit.from_dict({'repository': 'r', 'sha1': 'abc', 'url': 'u', 'refactorings': []})
+        RefactoringMinerCommit(repository='r', sha1='abc', url='u', refactorings=[])
+        """
+        return cls(dct['repository'], dct['sha1'], dct['url'], dct['refactorings'])
 
-@dataclass
-class RefactoringMinerOutput:
-    commits: List[RefactoringMinerCommit] = field(default_factory=list)
+
+def iter_refactoring_miner_output(f) -> Generator[RefactoringMinerCommit, None, None]:
+    for dct in iter_array(f, key='commits'):
+        yield RefactoringMinerCommit.from_dict(dct)
+
+
+class RefactoringMinerWorker:
+    """
+    A long-lived RefactoringMiner JVM bound to one repository (see java/RefactoringMinerWorker.java).
+
+    Requests are sent over stdin, per-commit results are streamed back over stdout as JSON lines.
+    If the process dies or does not answer within the timeout, it is killed and started again,
+    and the commits of the interrupted request are reported as not analyzed.
+    If it dies `MAX_WORKER_FAILURES` times in a row without any output (e.g. Java or the classpath is missing),
+    `RefactoringMinerWorkerError` is raised, so that the project is not marked as run.
+    """
+    worker_source = commit_explorer_root / 'tools' / 'java' / 'RefactoringMinerWorker.java'
+
+    def __init__(self, path_to_tool: Path, working_dir: Path):
+        self.path_to_tool = path_to_tool
+        self.working_dir = working_dir
+        self.process: Optional[subprocess.Popen] = None
+        self.lines: Optional[queue.Queue] = None
+        self.n_failures = 0
+
+    def __enter__(self) -> 'RefactoringMinerWorker':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self) -> None:
+        classpath = str(Path(self.path_to_tool).parent / 'lib' / '*')
+        cmd = ["java", "-cp", classpath, str(self.worker_source), str(self.working_dir)]
+        logger.debug(f'Starting RefactoringMiner worker: {cmd}')
+        self.process = subprocess.Popen(cmd, cwd=self.path_to_tool, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, encoding='utf-8', bufsize=1)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_stdout, args=(self.process, self.lines), daemon=True).start()
+
+    @staticmethod
+    def _read_stdout(process: subprocess.Popen, lines: queue.Queue) -> None:
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+
+    def fail(self, message: str) -> None:
+        self.n_failures += 1
+        if self.n_failures >= MAX_WORKER_FAILURES:
+            self.stop()
+            raise RefactoringMinerWorkerError(f'RefactoringMiner worker failed {self.n_failures} times in a row without any output, '
+                                              f'last failure: {message}')
+        logger.warning(f'{message}, restarting it ...')
+        self.restart()
+
+    def _request(self, request: str, timeout: Optional[int] = None) -> Generator[Dict[str, Any], None, None]:
+        if self.process is None or self.process.poll() is not None:
+            logger.warning('RefactoringMiner worker is not running, restarting it ...')
+            self.restart()
+        try:
+            self.process.stdin.write(request + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            self.fail(f'Could not send request "{request}" to RefactoringMiner worker')
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+            except queue.Empty:
+                logger.warning(f"Request {request} to RefactoringMiner worker was interrupted because of the timeout.")
+                self.restart()
+                return
+            if line is None:
+                self.fail(f'RefactoringMiner worker crashed while processing request {request}')
+                return
+            self.n_failures = 0
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f'Cannot decode RefactoringMiner worker output: {line[:200]}')
+                continue
+            if message.get('done'):
+                return
+            if 'error' in message and 'sha1' not in message:
+                logger.warning(f'RefactoringMiner worker failed to process request {request}: {message["error"]}')
+                continue
+            yield message
+
+    def run_on_range(self, older_sha: Sha, newer_sha: Sha, timeout: Optional[int] = None) -> Dict[Sha, List]:
+        return {m['sha1']: m['refactorings'] for m in self._request(f'range {older_sha} {newer_sha}', timeout) if 'error' not in m}
+
+    def run_on_commit(self, sha: Sha, timeout: int) -> Dict[Sha, List]:
+        return {m['sha1']: m['refactorings'] for m in self._request(f'commit {sha} {timeout}', timeout + 10) if 'error' not in m}
 
 
 class RefactoringMiner(Tool):
+    use_worker = True
+    max_seconds_per_commit = 6
+
+    _worker: Optional[RefactoringMinerWorker] = None
+
     def run_on_commit(self, commit: pygit2.Commit):
         raise NotImplementedError()
 
@@ -37,10 +173,20 @@ class RefactoringMiner(Tool):
         repo, metadata = clone_project(project, self.token, return_metadata=True)
         if not Tool.is_java_project(metadata['langs']):
             logger.info(f'{type(self).__name__}: not a java project, skipping ...')
-        else:
-            return super(RefactoringMiner, self).run_on_project(project, commits_new_to_old, limited_to_shas)
+            return
+        if not self.use_worker:
+            yield from super(RefactoringMiner, self).run_on_project(project, commits_new_to_old, limited_to_shas)
+            return
+        with RefactoringMinerWorker(self.path, path_to_working_dir(repo)) as worker:
+            self._worker = worker
+            try:
+                yield from super(RefactoringMiner, self).run_on_project(project, commits_new_to_old, limited_to_shas)
+            finally:
+                self._worker = None
 
     def run_on_commit_range(self, commit_range: List[pygit2.Commit], repo: Repository, timeout: Optional[int] = None, limited_to_shas: Optional[Set[Sha]] = None) -> Dict[Sha, List]: #TODO run on commit also for sstubs?
+        if self._worker is not None:
+            return self._run_on_commit_range_with_worker(commit_range, timeout, limited_to_shas)
         older_commit = commit_range[-1]
         newer_commit = commit_range[0]
         with tempfile.NamedTemporaryFile() as f:
@@ -52,15 +198,36 @@ class RefactoringMiner(Tool):
                 subprocess.run(cmd, cwd=self.path, capture_output=True, check=True, timeout=timeout)
             except subprocess.TimeoutExpired:
                 logger.warning(f"Process {cmd} was interrupted because of the timeout.")
-            try:
-                output: RefactoringMinerOutput = jsons.loads(f.read(), RefactoringMinerOutput)
-                dct = {c.sha1: {'status': 'ok', 'refactorings': c.refactorings} for c in output.commits}
-                n_refactorings = len(dct.keys())
-                for commit in commit_range[:-1]:
-                    if commit.hex not in dct:
-                        dct[commit.hex] = {'status': 'not-analyzed'}
-                logger.debug(f'Refactorings detected: {n_refactorings}/{len(commit_range) - 1}')
-            except DecodeError:
-                logger.warning('Decode error')
-                dct = {commit.hex: {'status': 'corrupted-output'} for commit in commit_range[:-1]}
+            dct = {}
+            missing_status = 'not-analyzed'
+            with open(f.name, encoding='utf-8') as output:
+                try:
+                    for c in iter_refactoring_miner_output(output):
+                        dct[c.sha1] = {'status': 'ok', 'refactorings': c.refactorings}
+                except (json.JSONDecodeError, KeyError):
+                    logger.warning('Decode error')
+                    missing_status = 'corrupted-output'
+            n_refactorings = len(dct.keys())
+            for commit in commit_range[:-1]:
+                if commit.hex not in dct:
+                    dct[commit.hex] = {'status': missing_status}
+            logger.debug(f'Refactorings detected: {n_refactorings}/{len(commit_range) - 1}')
             return dct
+
+    def _run_on_commit_range_with_worker(self, commit_range: List[pygit2.Commit], timeout: Optional[int] = None, limited_to_shas: Optional[Set[Sha]] = None) -> Dict[Sha, Dict[str, Any]]:
+        older_commit = commit_range[-1]
+        newer_commit = commit_range[0]
+        if limited_to_shas is not None:
+            refactorings = {}
+            for commit in commit_range[:-1]:
+                if commit.hex in limited_to_shas:
+                    refactorings.update(self._worker.run_on_commit(commit.hex, timeout=self.max_seconds_per_commit * 10))
+        else:
+            logger.debug(f'Processing commits from {older_commit.hex} to {newer_commit.hex} with RefactoringMiner worker ...')
+            refactorings = self._worker.run_on_range(older_commit.hex, newer_commit.hex, timeout=timeout)
+        dct = {sha: {'status': 'ok', 'refactorings': r} for sha, r in refactorings.items()}
+        for commit in commit_range[:-1]:
+            if commit.hex not in dct and (limited_to_shas is None or commit.hex in limited_to_shas):
+                dct[commit.hex] = {'status': 'not-analyzed'}
+        logger.debug(f'Refactorings detected: {len(refactorings)}/{len(commit_range) - 1}')
+        return dct
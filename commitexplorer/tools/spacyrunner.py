@@ -1,11 +1,22 @@
 import jsons
 import pydriller
 
-from commitexplorer.common import Tool
-# from commitexplorer.tools.nlp import get_commit_cores, nlp
+from commitexplorer.common import Tool, CommitBatch
+from commitexplorer.tools.nlp import get_commit_cores, get_commit_cores_batch, load_model
 
 
 class SpacyRunner(Tool):
+    lightweight_commits = True
+    batch_api = True
+    # commits per result batch, smaller than the default so that parsed messages are saved while mining
+    batch_size = 10000
+    # tunables of spaCy's nlp.pipe
+    pipe_batch_size = 1000
+    n_process = 1
 
     def run_on_commit(self, commit: pydriller.Commit):
-        return {'parsed_message': jsons.dump(get_commit_cores(commit.msg, nlp))}
\ No newline at end of file
+        return {'parsed_message': jsons.dump(get_commit_cores(commit.message, load_model()))}
+
+    def run_on_batch(self, batch: CommitBatch):
+        parsed_messages = get_commit_cores_batch(batch.messages, load_model(), self.pipe_batch_size, self.n_process)
+        return {sha: {'parsed_message': jsons.dump(parsed_message)} for sha, parsed_message in zip(batch.shas, parsed_messages)}
@@ -1,11 +1,15 @@
 import pydriller
 import pygit2
 
-from commitexplorer.common import Tool
+from commitexplorer.common import Tool, CommitBatch
 
 
 class SpecialCommitFinder(Tool):
+    batch_api = True
 
     def run_on_commit(self, commit: pydriller.Commit):
         return {'merge': commit.merge, 'initial': len(commit.parents) == 0}
 
+    def run_on_batch(self, batch: CommitBatch):
+        return {sha: {'merge': len(parent_ids) > 1, 'initial': len(parent_ids) == 0} for sha, parent_ids in zip(batch.shas, batch.parent_ids)}
+
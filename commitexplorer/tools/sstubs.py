@@ -1,22 +1,30 @@
 import json
 import logging
 import os
+import sqlite3
 import subprocess
 import tempfile
+from contextlib import closing
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Optional, Set, Generator, Iterable, Tuple
 
 import pydriller
 import pygit2
+from pygit2 import Repository
 
 from commitexplorer.common import Tool, clone_project, GithubProject, Sha, path_to_working_dir
+from commitexplorer.util.jsonstream import iter_array
 
 
 logger = logging.getLogger(__name__)
 
 
 class SStubs(Tool):
-    def run_on_project(self, project: GithubProject, all_shas: List[pygit2.Commit], limited_to_shas: Optional[Set[Sha]] = None) -> Dict[Sha, Dict[str, Any]]:
+    batch_size = 1000
+
+    def run_on_project(self, project: GithubProject, all_shas: List[pygit2.Commit], limited_to_shas: Optional[Set[Sha]] = None) -> Generator[Dict[Sha, Dict[str, Any]], None, None]:
         # TODO implement limited_to_shas
         repo, metadata = clone_project(project, self.token, return_metadata=True)
         if not Tool.is_java_project(metadata['langs']):
@@ -31,23 +39,100 @@ class SStubs(Tool):
                 cmd = ["java", "-jar", "miner.jar", str(project_path), str(output_path)]
                 subprocess.run(cmd, cwd=self.path, capture_output=True, check=True)
 
-                result: Dict[Sha, Dict[str, Any]] = {}
-                with open(output_path / 'bugs.json') as g:
-                    bugs: List[Dict] = json.load(g)
-                    for bug in bugs:
-                        sha = bug['fixCommitSHA1']
-                        if sha not in result:
-                            result[sha] = {'bugs': [], 'sstubs': []}
-                        result[sha]['bugs'].append(bug)
-
-                with open(output_path / 'sstubs.json') as g:
-                    sstubs: List[Dict] = json.load(g)
-                    for sstub in sstubs:
-                        sha = Sha(bug['fixCommitSHA1'])
-                        if sha not in result:
-                            result[sha] = {'sstubs': []}
-                        result[sha]['sstubs'].append(sstub)
-            yield result
+                for batch in self.batches(self.read_output(output_path), self.batch_size):
+                    yield batch
+
+    @staticmethod
+    def read_output(output_path: Path) -> Generator[Tuple[Sha, Dict[str, Any]], None, None]:
+        """
+        Streams bugs.json and sstubs.json one record at a time into an on-disk SQLite table next to them
+        and yields the records grouped by fix commit, one commit at a time, so memory use does not grow with the output.
+
+        >>> with tempfile.TemporaryDirectory() as f:
+        ...     _ = (Path(f) / 'bugs.json').write_text('[{"fixCommitSHA1": "b"}, {"fixCommitSHA1": "a"}, {"fixCommitSHA1": "b"}]')
+        ...     _ = (Path(f) / 'sstubs.json').write_text('[{"fixCommitSHA1": "b", "x": 1}]')
+        ...     list(SStubs.read_output(Path(f)))
+        [('a', {'bugs': [{'fixCommitSHA1': 'a'}], 'sstubs': []}), ('b', {'bugs': [{'fixCommitSHA1': 'b'}, {'fixCommitSHA1': 'b'}], 'sstubs': [{'fixCommitSHA1': 'b', 'x': 1}]})]
+        """
+        with closing(sqlite3.connect(str(output_path / '_records.sqlite'))) as records:
+            records.execute('CREATE TABLE records (sha TEXT, kind TEXT, record TEXT)')
+            for kind in ['bugs', 'sstubs']:
+                with open(output_path / f'{kind}.json') as g:
+                    records.executemany('INSERT INTO records VALUES (?, ?, ?)',
+                                        ((record['fixCommitSHA1'], kind, json.dumps(record)) for record in iter_array(g)))
+            records.commit()
+            rows = records.execute('SELECT sha, kind, record FROM records ORDER BY sha, rowid')
+            for sha, group in groupby(rows, key=itemgetter(0)):
+                result = {'bugs': [], 'sstubs': []}
+                for _, kind, record in group:
+                    result[kind].append(json.loads(record))
+                yield Sha(sha), result
+
+    @staticmethod
+    def batches(results: Iterable[Tuple[Sha, Dict[str, Any]]], batch_size: int) -> Generator[Dict[Sha, Dict[str, Any]], None, None]:
+        """
+        >>> [b for b in SStubs.batches([('a', 1), ('b', 2), ('c', 3)], 2)]
+        [{'a': 1, 'b': 2}, {'c': 3}]
+        """
+        batch = {}
+        for sha, value in results:
+            batch[sha] = value
+            if len(batch) >= batch_size:
+                yield batch
+                batch = {}
+        if batch:
+            yield batch
 
     def run_on_commit(self, commit: pydriller.Commit):
         raise NotImplemented()
+
+
+class ChunkedSStubs(SStubs):
+    """
+    Runs the SStuBs miner on chunks of the history instead of the whole project.
+
+    Every chunk is fetched into a shallow temporary repository, so the miner only walks the commits of this chunk.
+    Results (also empty ones) are reported for every analyzed commit, which lets `mine` resume a crashed
+    or interrupted run from the first unexplored commit and write results chunk by chunk.
+    """
+
+    def run_on_project(self, project: GithubProject, commits_new_to_old: List[pygit2.Commit], limited_to_shas: Optional[Set[Sha]] = None) -> Generator[Dict[Sha, Dict[str, Any]], None, None]:
+        repo, metadata = clone_project(project, self.token, return_metadata=True)
+        if not Tool.is_java_project(metadata['langs']):
+            logger.info(f'{type(self).__name__}: not a java project, skipping ...')
+            return
+        yield from Tool.run_on_project(self, project, commits_new_to_old, limited_to_shas)
+
+    @staticmethod
+    def fetch_commit_range(working_dir: Path, path: Path, commit_range: List[pygit2.Commit]) -> None:
+        newer_commit = commit_range[0]
+        git = ["git", "-c", "uploadpack.allowAnySHA1InWant=true", "-C", str(path)]
+        subprocess.run(["git", "init", "-q", str(path)], capture_output=True, check=True)
+        # history of the newest commit, deep enough to contain the chunk if it is linear
+        subprocess.run(git + ["fetch", "-q", f"--depth={len(commit_range)}", f"file://{working_dir}", newer_commit.hex],
+                       capture_output=True, check=True)
+        # every commit of the chunk together with its parents, also the ones not reachable from the newest commit
+        refspecs = [f"{commit.hex}:refs/heads/chunk-{i}" for i, commit in enumerate(commit_range[:-1])]
+        subprocess.run(git + ["fetch", "-q", "--depth=2", f"file://{working_dir}", *refspecs], capture_output=True, check=True)
+        subprocess.run(git + ["checkout", "-q", newer_commit.hex], capture_output=True, check=True)
+
+    def run_on_commit_range(self, commit_range: List[pygit2.Commit], repo: Repository, timeout: Optional[int] = None, limited_to_shas: Optional[Set[Sha]] = None) -> Dict[Sha, Dict[str, Any]]:
+        shas = [commit.hex for commit in commit_range[:-1] if limited_to_shas is None or commit.hex in limited_to_shas]
+        if not shas:
+            return {}
+        with tempfile.TemporaryDirectory() as f:
+            working_dir = path_to_working_dir(repo)
+            project_path = Path(f) / 'project'
+            output_path = Path(f) / 'output'
+            cmd = ["java", "-jar", "miner.jar", str(project_path), str(output_path)]
+            try:
+                self.fetch_commit_range(working_dir, project_path / working_dir.name, commit_range)
+                subprocess.run(cmd, cwd=self.path, capture_output=True, check=True, timeout=timeout)
+                result = dict(self.read_output(output_path))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Process {cmd} was interrupted because of the timeout.")
+                return {sha: {'status': 'timeout'} for sha in shas}
+            except (subprocess.CalledProcessError, OSError, json.JSONDecodeError, sqlite3.Error) as ex:
+                logger.warning(f"Mining sstubs from {commit_range[-1].hex} to {commit_range[0].hex} failed: {type(ex).__name__}, {ex}")
+                return {sha: {'status': 'error'} for sha in shas}
+        return {sha: {'status': 'ok', **result.get(sha, {'bugs': [], 'sstubs': []})} for sha in shas}
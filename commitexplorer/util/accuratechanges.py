@@ -1,9 +1,11 @@
 # code by @furunkel
+import math
+import re
 from difflib import SequenceMatcher
+from typing import Dict, Optional, Iterable, Tuple, List, Generator
+
 import whatthepatch
-import pandas as pd
 from io import StringIO
-import numpy as np
 
 class ChangeDiffer:
     def __init__(self, source, target):
@@ -53,7 +55,7 @@ def calculate_changes(patch):
 
     #print("\n"*5)
     #print(patch)
-    if pd.isna(patch): return np.nan
+    if patch is None or patch != patch: return math.nan
 
     def get_change_type(change):
         if change.old is not None and change.new is None: return 'deleted'
@@ -96,4 +98,112 @@ def calculate_changes(patch):
     out_changes = ' '.join(out_changes)
     #print(out_changes)
     #print("\n"*5)
-    return out_changes
\ No newline at end of file
+    return out_changes
+
+
+HUNK_HEADER_REGEX = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+Change = Tuple[Optional[str], Optional[str]]
+
+
+def parse_hunks(patch: str) -> Generator[List[Change], None, None]:
+    """
+    Splits a unified diff into hunks, every hunk being a list of (old_line, new_line) pairs:
+    (line, None) for a deleted line, (None, line) for an inserted one and (line, line) for context.
+    Hunk line counts from the headers are respected, so content lines starting with '---' or '+++' are not mistaken for headers.
+
+    >>> list(parse_hunks('@@ -1,2 +1,2 @@\\n a\\n--- b\\n+++ c\\n\\\\ No newline at end of file\\n'))
+    [[('a', 'a'), ('-- b', None), (None, '++ c')]]
+    >>> list(parse_hunks('@@ -1 +0,0 @@\\n-a\\n@@ -5,0 +5 @@\\n+b'))
+    [[('a', None)], [(None, 'b')]]
+    """
+    old_left = new_left = 0
+    hunk = None
+    for line in patch.split('\n'):
+        if old_left > 0 or new_left > 0:
+            origin, content = line[:1], line[1:]
+            if origin == '-':
+                hunk.append((content, None))
+                old_left -= 1
+            elif origin == '+':
+                hunk.append((None, content))
+                new_left -= 1
+            elif origin == '\\':
+                pass
+            else:
+                hunk.append((content, content))
+                old_left -= 1
+                new_left -= 1
+            continue
+        matcher = HUNK_HEADER_REGEX.match(line)
+        if matcher:
+            if hunk is not None:
+                yield hunk
+            hunk = []
+            old_count, new_count = matcher.groups()
+            old_left = int(old_count) if old_count is not None else 1
+            new_left = int(new_count) if new_count is not None else 1
+    if hunk is not None:
+        yield hunk
+
+
+def _line_change(before: str, after: str, max_line_length: Optional[int], cache: Dict[Tuple[str, str], str]) -> str:
+    if before == after:
+        return f'<eq>{after}</eq>' if after else ''
+    if not before:
+        return f'<ins>{after}</ins>'
+    if not after:
+        return f'<del>{before}</del>'
+    if max_line_length is not None and len(before) + len(after) > max_line_length:
+        return f'<re>{before}<to>{after}</re>'
+    if (before, after) not in cache:
+        cache[(before, after)] = ChangeDiffer(before, after).get_change()
+    return cache[(before, after)]
+
+
+def changes_from_hunks(hunks: Iterable[Iterable[Change]], max_line_length: Optional[int] = None) -> str:
+    """
+    Same output as `calculate_changes` but computed from already structured hunks (see `parse_hunks`).
+
+    A deleted line directly followed by an inserted one is diffed character-wise;
+    identical, purely inserted and purely deleted lines skip the matcher, and repeated line pairs
+    (common in generated or moved code) are served from a cache that lives only for this call.
+    If `max_line_length` is set, pairs of longer lines are reported as a single replacement without diffing them.
+
+    >>> changes_from_hunks([[('a', 'a'), ('int x = 1;', None), (None, 'int y = 1;'), (None, 'z')]])
+    '<eq>int </eq><re>x<to>y</re><eq> = 1;</eq> <ins>z</ins>'
+    >>> changes_from_hunks([[('abc', None), (None, 'abd')]], max_line_length=4)
+    '<re>abc<to>abd</re>'
+    """
+    changes = [change for hunk in hunks for change in hunk]
+    cache: Dict[Tuple[str, str], str] = {}
+    out_changes = []
+    i = 0
+    n = len(changes)
+    while i < n:
+        old, new = changes[i]
+        if new is None:
+            line = old.strip()
+            if i + 1 < n and changes[i + 1][0] is None:
+                out_changes.append(_line_change(line, changes[i + 1][1].strip(), max_line_length, cache))
+                i += 1
+            else:
+                out_changes.append(_line_change(line, '', max_line_length, cache))
+        elif old is None:
+            out_changes.append(_line_change('', new.strip(), max_line_length, cache))
+        i += 1
+    return ' '.join(out_changes)
+
+
+def fast_calculate_changes(patch: Optional[str], max_line_length: Optional[int] = None) -> str:
+    """
+    Drop-in replacement for `calculate_changes` without re-parsing the patch with whatthepatch.
+
+    >>> fast_calculate_changes('@@ -1,2 +1,2 @@\\n-a b\\n+a c\\n x')
+    '<eq>a </eq><re>b<to>c</re>'
+    >>> fast_calculate_changes(None)
+    nan
+    """
+    if patch is None or patch != patch:
+        return math.nan
+    return changes_from_hunks(parse_hunks(patch), max_line_length)
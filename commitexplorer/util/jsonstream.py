@@ -0,0 +1,106 @@
+import json
+from io import StringIO
+from typing import Any, Generator, Optional, TextIO
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _Buffer:
+    def __init__(self, f: TextIO, read_size: int):
+        self.f = f
+        self.read_size = read_size
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos > len(self.text) // 2:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.text += chunk
+        return True
+
+    def skip_whitespace(self) -> None:
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text) or not self.fill():
+                return
+
+    def peek(self) -> str:
+        self.skip_whitespace()
+        return self.text[self.pos] if self.pos < len(self.text) else ''
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise json.JSONDecodeError(f'Expecting {char!r}', self.text, self.pos)
+        self.pos += 1
+
+    def decode_value(self) -> Any:
+        self.skip_whitespace()
+        read_size = self.read_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number at the very end of the buffer might continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # grow reads geometrically so that huge values are not re-parsed too many times
+            chunk = self.f.read(read_size)
+            if not chunk:
+                self.eof = True
+            self.text += chunk
+            read_size *= 2
+
+
+def iter_array(f: TextIO, key: Optional[str] = None, read_size: int = 1 << 16) -> Generator[Any, None, None]:
+    """
+    Incrementally decodes a JSON array and yields its elements one by one, so that only one element
+    is held in memory at a time. If `key` is given, the array is expected to be the value of this key in the top-level object.
+
+    >>> list(iter_array(StringIO('[1, {"a": [2]}, "x", 345]'), read_size=2))
+    [1, {'a': [2]}, 'x', 345]
+    >>> list(iter_array(StringIO('{"other": {"b": 1}, "commits": [{"sha1": "a"}, {"sha1": "b"}]}'), key='commits', read_size=3))
+    [{'sha1': 'a'}, {'sha1': 'b'}]
+    >>> list(iter_array(StringIO(' [ ] ')))
+    []
+    >>> list(iter_array(StringIO('{"commits": [{"sha1": "a"}, {"sha1"'), key='commits'))
+    Traceback (most recent call last):
+    ...
+    json.decoder.JSONDecodeError: Expecting ':' delimiter: line 1 column 36 (char 35)
+    """
+    buffer = _Buffer(f, read_size)
+    if key is not None:
+        buffer.expect('{')
+        while True:
+            if buffer.peek() == '}':
+                return
+            current_key = buffer.decode_value()
+            buffer.expect(':')
+            if current_key == key:
+                break
+            buffer.decode_value()
+            if buffer.peek() == ',':
+                buffer.pos += 1
+
+    buffer.expect('[')
+    if buffer.peek() == ']':
+        return
+    while True:
+        yield buffer.decode_value()
+        if buffer.peek() == ',':
+            buffer.pos += 1
+        else:
+            buffer.expect(']')
+            return
@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+from typing import Any, Dict, Set
+
+from commitexplorer.common import Sha, ProjectObj
+from commitexplorer.db import save_results, mark_project_as_run, SAVE_RESULTS_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+_STOP = object()
+
+
+class ResultWriter:
+    """
+    Write-behind pipeline between tool execution and the database.
+
+    Result batches are put into a bounded queue and written by a dedicated thread, so that tools keep running
+    while the previous batch is being saved. Producers block when the queue is full. Consecutive batches of the same
+    project are coalesced into one `save_results` call. Marking a project as run is queued behind its results
+    and is skipped if any of them failed to be written, so a project is only considered mined once its results are durable.
+    """
+    def __init__(self, database, max_queue_size: int = 16, max_batch_commits: int = SAVE_RESULTS_BATCH_SIZE):
+        self.database = database
+        self.max_batch_commits = max_batch_commits
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.failed_projects: Set[ProjectObj] = set()
+        self.thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def save_results(self, results: Dict[Sha, Dict[str, Any]], project: ProjectObj) -> None:
+        self.queue.put(('results', project, results))
+
+    def mark_project_as_run(self, project: ProjectObj, tool_id: str) -> None:
+        self.queue.put(('mark', project, tool_id))
+
+    def flush(self) -> None:
+        self.queue.join()
+
+    def close(self) -> None:
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self) -> None:
+        next_item = None
+        while True:
+            item = next_item if next_item is not None else self.queue.get()
+            next_item = None
+            if item is _STOP:
+                self.queue.task_done()
+                return
+            kind, project, payload = item
+            n_items = 1
+            if kind == 'results':
+                results = payload
+                while len(results) < self.max_batch_commits:
+                    try:
+                        candidate = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if candidate is not _STOP and candidate[0] == 'results' and candidate[1] == project:
+                        for sha, tool_results in candidate[2].items():
+                            results.setdefault(sha, {}).update(tool_results)
+                        n_items += 1
+                    else:
+                        next_item = candidate
+                        break
+                self._save_results(results, project)
+            else:
+                self._mark_project_as_run(project, payload)
+            for _ in range(n_items):
+                self.queue.task_done()
+
+    def _save_results(self, results: Dict[Sha, Dict[str, Any]], project: ProjectObj) -> None:
+        try:
+            save_results(results, project, self.database)
+        except Exception as ex:
+            logger.exception(f"Exception: {type(ex).__name__}, {ex}, could not save {len(results)} results (project: {project})")
+            self.failed_projects.add(project)
+
+    def _mark_project_as_run(self, project: ProjectObj, tool_id: str) -> None:
+        if project in self.failed_projects:
+            logger.warning(f'Not marking {tool_id} as run on {project}: some of its results could not be saved.')
+            return
+        try:
+            mark_project_as_run(project, tool_id, self.database)
+        except Exception as ex:
+            logger.exception(f"Exception: {type(ex).__name__}, {ex}, could not mark {tool_id} as run (project: {project})")
@@ -1,67 +1,468 @@
+import argparse
+import base64
+import binascii
+import gzip
+import hashlib
 import http.server
-import socketserver
-import re
 import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, unquote
 
 from pymongo import MongoClient
+from pymongo.errors import ExecutionTimeout, ConnectionFailure
+
+from commitexplorer.blobstore import BlobStore, inline_blobs
+from commitexplorer.db import get_commit, iter_commits, iter_shas_with_field, count_shas_with_field, get_projection, get_commit_version, \
+    get_issues_version
+from commitexplorer.stats import get_stats, get_tool_stats
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 
 PORT = 8180
 
 sha_regex=re.compile('[0-9a-f]{40}')
 
-client = MongoClient('mongodb://localhost:27017')
-commit_collection = client['commit_explorer']['commits']
-issue_collection = client['commit_explorer']['issues']
+MAX_PAGE_SIZE = 100000
+MAX_BATCH_SHAS = 1000
+MAX_REQUEST_BODY_SIZE = 1024 * 1024
+NDJSON_LINES_PER_WRITE = 1000
+# smaller responses are not worth compressing
+MIN_GZIP_SIZE = 1024
 
 
-class MyHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, request, client_address, server, directory=None):
-        super().__init__(request, client_address, server)
-        super().__init__(request, client_address, server)
+def dumps(payload: Any) -> bytes:
+    """
+    >>> dumps({'a': [1, None]})
+    b'{"a":[1,null]}'
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=str)
+    return json.dumps(payload, default=str, separators=(',', ':')).encode('utf-8')
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    >>> accepts_gzip('gzip, deflate, br'), accepts_gzip('br;q=1.0, gzip;q=0'), accepts_gzip(None)
+    (True, False, False)
+    """
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip() in ['gzip', '*']:
+            return params.replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']
+    return False
+
+
+class CachedResponse:
+    def __init__(self, etag: str, body: bytes):
+        self.etag = etag
+        self.body = body
+        self.gzipped_body: Optional[bytes] = None
+
+    def get_gzipped_body(self) -> bytes:
+        if self.gzipped_body is None:
+            self.gzipped_body = gzip.compress(self.body, compresslevel=5)
+        return self.gzipped_body
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + (len(self.gzipped_body) if self.gzipped_body is not None else 0)
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of serialized responses bounded by their total size in bytes.
+    Entries are keyed by (sha, projection) and hold the ETag of the commit version they were created from,
+    so an entry of an outdated version is never served.
+
+    >>> cache = ResponseCache(max_bytes=10)
+    >>> cache.put(('a', None), CachedResponse('"1"', b'12345'))
+    >>> cache.put(('b', None), CachedResponse('"1"', b'12345'))
+    >>> cache.get(('a', None), '"1"').body, cache.get(('a', None), '"2"')
+    (b'12345', None)
+    >>> cache.put(('c', None), CachedResponse('"1"', b'12345'))
+    >>> cache.get(('b', None), '"1"'), len(cache.entries)
+    (None, 2)
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: 'OrderedDict[Tuple, CachedResponse]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple, etag: str) -> Optional[CachedResponse]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.etag != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple, entry: CachedResponse) -> None:
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            self.resize()
+
+    def resize(self) -> None:
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def update_size(self, key: Tuple, entry: CachedResponse, old_size: int) -> None:
+        # the gzipped body is added to an entry lazily, when it is first requested
+        with self.lock:
+            if self.entries.get(key) is entry:
+                self.size += entry.size - old_size
+                self.resize()
+
+
+def get_etag(sha: str, version: Any, projection_key: str) -> str:
+    return '"' + hashlib.sha1(f'{sha}|{version}|{projection_key}'.encode('utf-8')).hexdigest()[:24] + '"'
+
+
+def encode_page_token(sha: str) -> str:
+    """
+    >>> encode_page_token('abc')
+    'YWJj'
+    """
+    return base64.urlsafe_b64encode(sha.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token: str) -> str:
+    """
+    >>> decode_page_token(encode_page_token('abc'))
+    'abc'
+    >>> decode_page_token('#')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid page token: #
+    """
+    try:
+        sha = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        sha = None
+    if not sha or encode_page_token(sha) != token:
+        raise ValueError(f'Invalid page token: {token}')
+    return sha
+
+
+def add_linked_issues(commits: List[Dict[str, Any]], issue_collection, max_time_ms: Optional[int] = None) -> None:
+    """
+    Fetches issues linked to all `commits` with one query and adds them as `linked_issues`,
+    in the order of the links; None for issues that are not found.
+    """
+    linked_issue_ids = {}
+    for commit in commits:
+        try:
+            linked_issue_ids[commit['_id']] = commit['links']['bohr']['issues']
+        except KeyError:
+            pass
+    if not linked_issue_ids:
+        return
+    all_issue_ids = list({issue_id for issue_ids in linked_issue_ids.values() for issue_id in issue_ids})
+    issues = {issue['_id']: issue for issue in issue_collection.find({'_id': {'$in': all_issue_ids}}).max_time_ms(max_time_ms)}
+    for commit in commits:
+        if commit['_id'] in linked_issue_ids:
+            commit['linked_issues'] = [issues.get(issue_id) for issue_id in linked_issue_ids[commit['_id']]]
+
 
+def parse_content_length(value: str) -> int:
+    """
+    >>> parse_content_length('12')
+    12
+    >>> parse_content_length('-1')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid Content-Length: -1
+    """
+    if not value.strip().isdigit():
+        raise ValueError(f'Invalid Content-Length: {value}')
+    return int(value)
+
+
+def parse_fields(value: Optional[Any]) -> Optional[List[str]]:
+    """
+    >>> parse_fields('message,files.filename'), parse_fields(['message']), parse_fields(None)
+    (['message', 'files.filename'], ['message'], None)
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [field for field in value.split(',') if field]
+    if isinstance(value, list) and all(isinstance(field, str) for field in value):
+        return value
+    raise ValueError(f'Fields must be a comma-separated string or a list of strings: {value}')
+
+
+class CommitExplorerServer(http.server.ThreadingHTTPServer):
+    """
+    Handles each request in its own thread, all threads share the MongoDB client and its connection pool.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, database, max_time_ms: Optional[int], request_timeout: Optional[float], cache_size: int = 256 * 1024 * 1024):
+        self.database = database
+        self.max_time_ms = max_time_ms
+        self.request_timeout = request_timeout
+        self.cache = ResponseCache(cache_size)
+        self.blob_store = BlobStore(database)
+        super().__init__(server_address, MyHttpRequestHandler)
+
+    def finish_request(self, request, client_address):
+        # a client that stops sending or reading does not hold its thread forever
+        request.settimeout(self.request_timeout)
+        super().finish_request(request, client_address)
+
+
+class MyHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
     def send200(self, payload):
+        self.send_body(dumps(payload))
+
+    def send_body(self, body: bytes, gzipped_body: Optional[bytes] = None, etag: Optional[str] = None):
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Vary', 'Accept-Encoding')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if len(body) >= MIN_GZIP_SIZE and accepts_gzip(self.headers.get('Accept-Encoding')):
+            body = gzipped_body if gzipped_body is not None else gzip.compress(body, compresslevel=5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached(self, key: Tuple, entry: CachedResponse):
+        if len(entry.body) >= MIN_GZIP_SIZE and accepts_gzip(self.headers.get('Accept-Encoding')):
+            old_size = entry.size
+            gzipped_body = entry.get_gzipped_body()
+            self.server.cache.update_size(key, entry, old_size)
+            return self.send_body(entry.body, gzipped_body, entry.etag)
+        self.send_body(entry.body, etag=entry.etag)
+
+    def send304(self, etag: str):
+        self.send_response(304)
+        self.send_header('ETag', etag)
         self.end_headers()
-        payload_bytes = json.dumps(payload).encode('utf-8')
-        self.wfile.write(payload_bytes)
 
     def handle_commit(self):
-        sha = self.path[len('/art-exp/commit/'):]
+        """
+        /art-exp/commit/<sha>?include=<fields>|exclude=<fields>, fields are comma-separated.
+        """
+        url = urlsplit(self.path)
+        sha = url.path[len('/art-exp/commit/'):]
         if not sha_regex.fullmatch(sha):
             return self.send_error(400, f'Invalid commit hashsum: {sha}')
-        commit = commit_collection.find_one({'_id': sha})
-        if commit is None:
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            projection = get_projection(parse_fields(params.get('include')), parse_fields(params.get('exclude')))
+        except ValueError as ex:
+            return self.send_error(400, str(ex))
+        database = self.server.database
+        # the version is looked up on every request, so responses of commits with newly saved results are never served from the cache
+        exists, version, issue_ids = get_commit_version(database, sha, self.server.max_time_ms)
+        if not exists:
             return self.send_error(404, f"Commit {sha} not found")
+        # linked issues are part of the response, so their versions are part of the ETag
+        issues_version = get_issues_version(database, issue_ids, self.server.max_time_ms) if version is not None else None
+        if version is None or issues_version is None:
+            # changes of documents without a version cannot be detected, so their responses are neither cached nor tagged
+            commit = self.load_commit(sha, projection)
+            return self.send_error(404, f"Commit {sha} not found") if commit is None else self.send200(commit)
+        projection_key = json.dumps(projection, sort_keys=True)
+        etag = get_etag(sha, f'{version}|{issues_version}', projection_key)
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            return self.send304(etag)
+        key = (sha, projection_key)
+        entry = self.server.cache.get(key, etag)
+        if entry is None:
+            commit = self.load_commit(sha, projection)
+            if commit is None:
+                return self.send_error(404, f"Commit {sha} not found")
+            entry = CachedResponse(etag, dumps(commit))
+            self.server.cache.put(key, entry)
+        self.send_cached(key, entry)
+
+    def load_commit(self, sha: str, projection: Optional[Dict[str, int]]) -> Optional[Dict[str, Any]]:
+        database = self.server.database
+        commit = get_commit(database, sha, max_time_ms=self.server.max_time_ms, projection=projection)
+        if commit is None:
+            return None
+        commit = inline_blobs(commit, self.server.blob_store)
+        add_linked_issues([commit], database['issues'], self.server.max_time_ms)
+        return commit
+
+    def handle_commits(self):
+        """
+        POST /art-exp/commits with {"shas": [...], "include": [...]} or {"shas": [...], "exclude": [...]}
+        returns {"commits": [...], "not_found": [...]}, commits are in the order of the requested shas.
+        """
+        content_length = self.headers.get('Content-Length')
+        if content_length is None:
+            return self.send_error(411, 'Content-Length is required')
         try:
-            issue_ids = commit['links']['bohr']['issues']
-            issues = [issue_collection.find_one({'_id': issue_id}) for issue_id in issue_ids]
-            commit['linked_issues'] = issues
-        except KeyError:
-            pass
-        self.send200(commit)
+            length = parse_content_length(content_length)
+        except ValueError as ex:
+            return self.send_error(400, str(ex))
+        if length > MAX_REQUEST_BODY_SIZE:
+            return self.send_error(413, f'Request body is larger than {MAX_REQUEST_BODY_SIZE} bytes')
+        try:
+            body = json.loads(self.rfile.read(length))
+            shas = body['shas']
+            if not isinstance(shas, list) or not all(isinstance(sha, str) and sha_regex.fullmatch(sha) for sha in shas):
+                raise ValueError('shas must be a list of commit hashsums')
+            projection = get_projection(parse_fields(body.get('include')), parse_fields(body.get('exclude')))
+        except (ValueError, KeyError, TypeError) as ex:
+            return self.send_error(400, f'Invalid request: {ex}')
+        if len(shas) > MAX_BATCH_SHAS:
+            return self.send_error(400, f'At most {MAX_BATCH_SHAS} commits can be requested at once')
+        database = self.server.database
+        # blobs of all commits are read with one query
+        commits = inline_blobs(list(iter_commits(database, shas, max_time_ms=self.server.max_time_ms, projection=projection)),
+                               self.server.blob_store)
+        add_linked_issues(commits, database['issues'], self.server.max_time_ms)
+        found = {commit['_id'] for commit in commits}
+        self.send200({'commits': commits, 'not_found': [sha for sha in shas if sha not in found]})
 
 
     def handle_query(self):
-        collection_id = self.path[len('/art-exp/query/'):]
-        ids = [sha['_id'] for sha in commit_collection.find({collection_id: {"$exists": True}}, {"_id": 1})]
-        print(f'Found {len(ids)} commits satisfying the query')
-        self.send200(ids)
+        """
+        /art-exp/query/<field> returns all shas of commits that have the field as a JSON array. Parameters:
+        `count=true` returns only their number: {"count": n};
+        `limit=n` returns a page: {"ids": [...], "next": <token or null>}, `after=<token>` returns the page following the token;
+        `format=ndjson` streams shas (the whole result or the page) as they are read, one JSON string per line.
+        """
+        url = urlsplit(self.path)
+        collection_id = unquote(url.path[len('/art-exp/query/'):])
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        database, max_time_ms = self.server.database, self.server.max_time_ms
+        if params.get('count') == 'true':
+            return self.send200({'count': count_shas_with_field(database, collection_id, max_time_ms=max_time_ms)})
+        try:
+            limit = int(params['limit']) if 'limit' in params else None
+            after = decode_page_token(params['after']) if 'after' in params else None
+        except ValueError as ex:
+            return self.send_error(400, str(ex))
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            return self.send_error(400, f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        ids = iter_shas_with_field(database, collection_id, max_time_ms=max_time_ms, after=after, limit=limit)
+        if params.get('format') == 'ndjson':
+            return self.stream_ndjson(ids)
+        ids = list(ids)
+        logger.info(f'Found {len(ids)} commits satisfying the query')
+        if limit is None and after is None:
+            return self.send200(ids)
+        next_token = encode_page_token(ids[-1]) if limit is not None and len(ids) == limit else None
+        self.send200({'ids': ids, 'next': next_token})
+
+    def handle_stats(self):
+        """
+        Precomputed stats (see `ce stats refresh`), each is a single document lookup:
+        /art-exp/stats/ of the whole database, /art-exp/stats/project/<owner>/<repo> of a project
+        and /art-exp/stats/tool/<field> of a tool across all projects.
+        """
+        path = unquote(urlsplit(self.path).path[len('/art-exp/stats/'):])
+        database, max_time_ms = self.server.database, self.server.max_time_ms
+        if path == '':
+            result = get_stats(database, max_time_ms=max_time_ms)
+        elif path.startswith('project/'):
+            result = get_stats(database, path[len('project/'):], max_time_ms=max_time_ms)
+        elif path.startswith('tool/'):
+            result = get_tool_stats(database, path[len('tool/'):], max_time_ms=max_time_ms)
+        else:
+            return self.send_error(404, f"Path not found: {self.path}")
+        if result is None:
+            return self.send_error(404, f"No stats found for {path or 'the database'}")
+        self.send200(result)
+
+    def stream_ndjson(self, items):
+        # the first item is read before sending the headers, so that query errors can still be reported with a status code
+        items = iter(items)
+        first = list(islice(items, 1))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        lines = [json.dumps(item) for item in first]
+        try:
+            for item in items:
+                lines.append(json.dumps(item))
+                if len(lines) >= NDJSON_LINES_PER_WRITE:
+                    self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                    lines = []
+        except (ExecutionTimeout, ConnectionFailure) as ex:
+            # the status line is already sent, so the error cannot be reported with send_error, the response is ended
+            # by closing the connection instead
+            logger.error(f'Streaming {self.path} failed: {type(ex).__name__}, {ex}')
+            self.close_connection = True
+            return
+        if lines:
+            self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
 
     def do_GET(self):
         if self.path.startswith('/art-exp'):
-            if self.path.startswith('/art-exp/commit/'):
-                self.handle_commit()
-            elif self.path.startswith('/art-exp/query/'):
-                self.handle_query()
-            else:
-                return self.send_error(404, f"Path not found: {self.path}")
+            try:
+                if self.path.startswith('/art-exp/commit/'):
+                    self.handle_commit()
+                elif self.path.startswith('/art-exp/query/'):
+                    self.handle_query()
+                elif self.path.startswith('/art-exp/stats/'):
+                    self.handle_stats()
+                else:
+                    return self.send_error(404, f"Path not found: {self.path}")
+            except ExecutionTimeout:
+                return self.send_error(504, f'Query took longer than {self.server.max_time_ms} ms')
+            except ConnectionFailure as ex:
+                return self.send_error(503, f'Database is not available: {type(ex).__name__}')
         else:
             return http.server.SimpleHTTPRequestHandler.do_GET(self)
 
+    def do_POST(self):
+        if urlsplit(self.path).path == '/art-exp/commits':
+            try:
+                self.handle_commits()
+            except ExecutionTimeout:
+                return self.send_error(504, f'Query took longer than {self.server.max_time_ms} ms')
+            except ConnectionFailure as ex:
+                return self.send_error(503, f'Database is not available: {type(ex).__name__}')
+        else:
+            return self.send_error(404, f"Path not found: {self.path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves commits from the commit explorer database.')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='commit_explorer')
+    parser.add_argument('--max-pool-size', type=int, default=100, help='Maximum number of connections to MongoDB.')
+    parser.add_argument('--server-selection-timeout-ms', type=int, default=5000)
+    parser.add_argument('--socket-timeout-ms', type=int, default=30000)
+    parser.add_argument('--max-time-ms', type=int, default=20000, help='Time limit for each database query.')
+    parser.add_argument('--request-timeout', type=float, default=60, help='Socket timeout for client connections, in seconds.')
+    parser.add_argument('--cache-size-mb', type=int, default=256, help='Maximum size of cached commit responses.')
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongodb_uri, maxPoolSize=args.max_pool_size, serverSelectionTimeoutMS=args.server_selection_timeout_ms,
+                         socketTimeoutMS=args.socket_timeout_ms)
+    httpd = CommitExplorerServer(("", args.port), client[args.database], args.max_time_ms, args.request_timeout,
+                                 args.cache_size_mb * 1024 * 1024)
+    print("serving at port", args.port)
+    httpd.serve_forever()
 
-Handler = MyHttpRequestHandler
-httpd = socketserver.TCPServer(("", PORT), Handler)
-print("serving at port", PORT)
-httpd.serve_forever()
 
+if __name__ == '__main__':
+    main()